@@ -0,0 +1,245 @@
+#!/usr/bin/python
+
+"""Microbenchmarks for the metric hot paths.
+
+    python bench.py core
+    python bench.py histogram
+    python bench.py summary
+    python bench.py storage
+    python bench.py snapshot
+    python bench.py proc
+
+Numbers are only comparable between runs on the same machine.
+"""
+
+import __builtin__
+import argparse
+import bisect
+import gc
+import io
+import os
+import random
+import threading
+import time
+
+from lib.prometheus_client import Gauge, Counter, Histogram, Summary, CollectorRegistry, generate_latest
+from lib.prometheus_client import PROCESS_COLLECTOR
+
+
+def proc_io():
+    with open("/proc/self/io") as f:
+        return dict((key, int(value)) for key, value in (line.split(":") for line in f))
+
+
+def rss_bytes():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * 4096
+
+
+def ops_per_sec(func, n):
+    start = time.time()
+    func(n)
+    return n / (time.time() - start)
+
+
+def bench_core(args):
+    registry = CollectorRegistry()
+    gauge = Gauge("bench_gauge", "Gauge for benchmarking.", ["device", "mode"], registry=registry)
+    counter = Counter("bench_counter", "Counter for benchmarking.", ["device"], registry=registry)
+
+    devices = ["eth%d" % i for i in xrange(args.series)]
+    for device in devices:
+        gauge.labels(device, "rx").set(0)
+        counter.labels(device).inc()
+
+    def labels_set(n):
+        for i in xrange(n):
+            gauge.labels(devices[i % len(devices)], "rx").set(i)
+
+    def set_many(n):
+        values = dict(((device, "rx"), 1.0) for device in devices)
+        for _ in xrange(n // len(devices)):
+            gauge.set_many(values)
+
+    def child_inc(n):
+        child = counter.labels(devices[0])
+        for _ in xrange(n):
+            child.inc()
+
+    def threaded_labels_inc(n):
+        def work():
+            for i in xrange(n // args.threads):
+                counter.labels(devices[i % len(devices)]).inc()
+        threads = [threading.Thread(target=work) for _ in xrange(args.threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    print "labels().set()          %10.0f ops/s" % ops_per_sec(labels_set, args.ops)
+    print "set_many()              %10.0f ops/s" % ops_per_sec(set_many, args.ops)
+    print "child.inc()             %10.0f ops/s" % ops_per_sec(child_inc, args.ops)
+    print "labels().inc() x%d thr   %10.0f ops/s" % (args.threads, ops_per_sec(threaded_labels_inc, args.ops))
+
+    gc.collect()
+    before = rss_bytes()
+    family = Gauge("bench_memory", "Gauge for measuring memory.", ["series"], registry=registry)
+    for i in xrange(args.children):
+        family.labels(str(i)).set(i)
+    gc.collect()
+    print "bytes per child         %10.0f" % (float(rss_bytes() - before) / args.children)
+
+
+def bench_histogram(args):
+    registry = CollectorRegistry()
+    histogram = Histogram("bench_histogram", "Histogram for benchmarking.", registry=registry)
+    values = [i * 0.0001 for i in xrange(1000)]
+
+    def observe(n):
+        for i in xrange(n):
+            histogram.observe(values[i % len(values)])
+
+    def observe_many(n):
+        for _ in xrange(n // len(values)):
+            histogram.observe_many(values)
+
+    print "observe()               %10.0f ops/s" % ops_per_sec(observe, args.ops)
+    print "observe_many()          %10.0f ops/s" % ops_per_sec(observe_many, args.ops)
+
+
+def bench_summary(args):
+    registry = CollectorRegistry()
+    plain = Summary("bench_plain", "Summary without quantiles.", registry=registry)
+    summary = Summary("bench_summary", "Summary for benchmarking.",
+                      quantiles=((0.5, 0.05), (0.9, 0.01), (0.99, 0.001)), registry=registry)
+    values = [random.expovariate(1.0) for _ in xrange(10000)]
+
+    def observe(metric):
+        def run(n):
+            for i in xrange(n):
+                metric.observe(values[i % len(values)])
+        return run
+
+    print "observe() plain         %10.0f ops/s" % ops_per_sec(observe(plain), args.ops)
+    print "observe() quantiles     %10.0f ops/s" % ops_per_sec(observe(summary), args.ops)
+
+    ranked = sorted(values)
+    for quantile in ("0.5", "0.9", "0.99"):
+        value = registry.get_sample_value("bench_summary", {"quantile": quantile})
+        rank = bisect.bisect_left(ranked, value) / float(len(ranked))
+        print "quantile %-6s         %10.4f rank" % (quantile, rank)
+
+
+def bench_storage(args):
+    def measure(name, columnar):
+        gc.collect()
+        before = rss_bytes()
+        registry = CollectorRegistry()
+        gauges = [Gauge("bench_storage_%d" % i, "Gauge for comparing storage.", ["device"],
+                        registry=registry, columnar=columnar) for i in xrange(16)]
+        devices = ["veth%d" % i for i in xrange(args.children // len(gauges))]
+        for gauge in gauges:
+            gauge.set_many(dict((device, 1.0) for device in devices))
+        gc.collect()
+        series = len(gauges) * len(devices)
+        print "%-8s bytes per series  %10.0f" % (name, float(rss_bytes() - before) / series)
+
+        generate_latest(registry)
+        for gauge in gauges:
+            gauge.set_many(dict((device, 2.0) for device in devices))
+        start = time.time()
+        generate_latest(registry)
+        print "%-8s scrape            %10.3f s" % (name, time.time() - start)
+
+    # A fresh process each, so freed memory of one is not reused by the other.
+    for name, columnar in (("object", False), ("columnar", True)):
+        pid = os.fork()
+        if pid == 0:
+            measure(name, columnar)
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+
+def bench_snapshot(args):
+    registry = CollectorRegistry()
+    gauges = [Gauge("bench_snapshot_%d" % i, "Gauge for snapshots.", ["device"], registry=registry)
+              for i in xrange(16)]
+    devices = ["veth%d" % i for i in xrange(args.children // len(gauges))]
+
+    def update(value):
+        for gauge in gauges:
+            gauge.set_many(dict((device, value) for device in devices))
+
+    def timed(func):
+        start = time.time()
+        result = func()
+        return time.time() - start, result
+
+    update(1.0)
+    generate_latest(registry)
+    update(2.0)
+    print "live render             %10.3f s" % timed(lambda: generate_latest(registry))[0]
+    update(3.0)
+    elapsed, snapshot = timed(registry.publish)
+    print "publish                 %10.3f s" % elapsed
+    print "snapshot render         %10.3f s" % timed(lambda: generate_latest(snapshot))[0]
+
+
+def bench_proc(args):
+    from plugins.base import System, LoadAvg, MemInfo
+    from plugins.net import NetDev
+
+    collects = [(plugin.__class__.__name__, plugin.collect)
+                for plugin in (System({}), LoadAvg({}), MemInfo({}), NetDev({"exclude": "lo"}))]
+    collects.append(("ProcessCollector", PROCESS_COLLECTOR.collect))
+    n = args.ops // 100
+
+    opens = [0]
+
+    def counting(func):
+        def wrapper(*args, **kwargs):
+            opens[0] += 1
+            return func(*args, **kwargs)
+        return wrapper
+
+    def measure(name, func):
+        func()
+        opens[0] = 0
+        before = proc_io()
+        start = time.time()
+        for _ in xrange(n):
+            func()
+        elapsed = time.time() - start
+        after = proc_io()
+        print "%-16s %8.1f us %6.1f opens %6.1f reads %8.0f bytes" % (
+            name, elapsed / n * 1e6, float(opens[0] - 1) / n,
+            float(after["syscr"] - before["syscr"]) / n, float(after["rchar"] - before["rchar"]) / n)
+
+    # Counts the files opened by the collectors, less the one of proc_io().
+    __builtin__.open, io.open = counting(__builtin__.open), counting(io.open)
+
+    for name, func in collects:
+        measure(name, func)
+    measure("scrape", lambda: [func() for _, func in collects])
+
+
+BENCHMARKS = {
+    "core": bench_core,
+    "histogram": bench_histogram,
+    "summary": bench_summary,
+    "storage": bench_storage,
+    "snapshot": bench_snapshot,
+    "proc": bench_proc,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Metric microbenchmarks.')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--ops', type=int, default=500000, help='operations per measurement')
+    parser.add_argument('--series', type=int, default=100, help='label sets to spread updates over')
+    parser.add_argument('--threads', type=int, default=4, help='threads for the contended run')
+    parser.add_argument('--children', type=int, default=100000, help='children created for the memory run')
+
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
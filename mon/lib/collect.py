@@ -0,0 +1,175 @@
+import logging
+import threading
+import time
+
+from lib.prometheus_client import Counter, Gauge, Histogram, REGISTRY
+
+from plugins import plugins
+from plugins.base_plugin import BasePlugin, NAMESPACE
+
+
+duration = Gauge("collector_duration_seconds",
+                 "Duration of the last collection of the collector.",
+                 labelnames=["collector"],
+                 subsystem="scrape",
+                 namespace=NAMESPACE)
+success = Gauge("collector_success",
+                "Whether the last collection of the collector succeeded.",
+                labelnames=["collector"],
+                subsystem="scrape",
+                namespace=NAMESPACE)
+duration_histogram = Histogram("collector_run_seconds",
+                               "Distribution of the collection time of the collector.",
+                               labelnames=["collector"],
+                               subsystem="scrape",
+                               namespace=NAMESPACE,
+                               buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0))
+evicted = Counter("collector_series_evicted",
+                  "Series of the collector dropped after not being updated for ttl collections.",
+                  labelnames=["collector"],
+                  subsystem="scrape",
+                  namespace=NAMESPACE)
+rejected = Counter("collector_series_rejected",
+                   "Lookups of new series of the collector refused by the series limit.",
+                   labelnames=["collector"],
+                   subsystem="scrape",
+                   namespace=NAMESPACE)
+# The refusals of every collector counted into `rejected` so far.
+_rejected_seen = {}
+
+
+def plugin_name(plugin):
+    return plugin.__class__.__name__.lower()
+
+
+def run_collect(plugin):
+    """Calls plugin.collect() and records its duration and outcome.
+
+    A successful collection ends a cycle for the ttl of the plugin's series.
+    Plugins without a collect() of their own, like Ping and MCU, write their
+    series from scheduler jobs on intervals of their own; a collection says
+    nothing about those, so their series are never expired here.
+
+    With snapshots, the collection is the one publisher of the plugin's
+    metrics: they are published right after collect(), on their own.
+    """
+    name = plugin_name(plugin)
+    ok = False
+    start = time.time()
+    try:
+        # Plugins may create metrics lazily, those belong to them as well.
+        with REGISTRY.owner(name):
+            plugin.collect()
+        if type(plugin).collect != BasePlugin.collect:
+            evicted.labels(name).inc(REGISTRY.expire(name, plugin.ttl))
+        if plugin.publish:
+            REGISTRY.publish([name], unowned=False)
+        ok = True
+    except Exception as e:
+        logging.error("Exception {} in {} while collecting".format(str(e), str(plugin.__class__.__name__)))
+    finally:
+        # Time can go backwards.
+        elapsed = max(time.time() - start, 0)
+        duration.labels(name).set(elapsed)
+        duration_histogram.labels(name).observe(elapsed)
+        success.labels(name).set(float(ok))
+        count_rejected(name)
+
+
+def count_rejected(name):
+    """Adds the refusals of the collector's series limit since the last call to `rejected`."""
+    total = REGISTRY.rejected(name)
+    # The total goes down when metrics of the collector are unregistered.
+    new = max(total - _rejected_seen.get(name, 0), 0)
+    _rejected_seen[name] = total
+    rejected.labels(name).inc(new)
+
+
+class PluginRun(object):
+    """Runs collect() of one plugin in its own thread.
+
+    A plugin is never collected twice at once: while a run is in progress
+    start() hands out the event of that run instead of starting another.
+    A plugin stuck in collect() therefore costs one thread, no matter how
+    many scrapes come by meanwhile.
+    """
+
+    def __init__(self, plugin):
+        self.plugin = plugin
+        self.name = plugin_name(plugin)
+
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._done.set()
+
+    def start(self):
+        with self._lock:
+            if self._done.is_set():
+                self._done = threading.Event()
+                thread = threading.Thread(target=self._run, args=(self._done,))
+                thread.daemon = True
+                thread.start()
+            return self._done
+
+    def _run(self, done):
+        try:
+            run_collect(self.plugin)
+        finally:
+            done.set()
+
+
+class Collector(object):
+    """Collects the scrape driven plugins in parallel.
+
+    Each plugin gets `timeout` seconds (or its own collect_timeout), and
+    the whole collection never takes longer than the budget passed to
+    collect(). Plugins that miss their deadline keep their last values and
+    are flagged in node_scrape_collector_stale.
+    """
+
+    def __init__(self, timeout=5.0, budget=10.0, offset=0.5):
+        self.timeout = timeout
+        self.budget = budget
+        # Seconds of the scraper's timeout left for rendering the response.
+        self.offset = offset
+
+        self._runs = {}
+        self._lock = threading.Lock()
+
+        self.stale = Gauge("collector_stale",
+                           "Whether the collector missed its deadline on the last scrape.",
+                           labelnames=["collector"],
+                           subsystem="scrape",
+                           namespace=NAMESPACE)
+
+    def _run_of(self, plugin):
+        with self._lock:
+            if plugin not in self._runs:
+                self._runs[plugin] = PluginRun(plugin)
+            return self._runs[plugin]
+
+    def collect(self, budget=None, names=None):
+        started = time.time()
+        if budget is None:
+            budget = self.budget
+
+        runs = [(self._run_of(plugin), plugin) for plugin in plugins
+                if not plugin.scheduled and (names is None or plugin_name(plugin) in names)]
+        waiting = [(run, run.start(), plugin) for run, plugin in runs]
+
+        for run, done, plugin in waiting:
+            timeout = plugin.collect_timeout or self.timeout
+            remaining = started + min(timeout, budget) - time.time()
+            done.wait(max(remaining, 0))
+
+            stale = not done.is_set()
+            if stale:
+                logging.warning("Collector {} missed its deadline, serving last values".format(run.name))
+            self.stale.labels(run.name).set(float(stale))
+
+
+collector = Collector()
+
+
+def collect_all(budget=None, names=None):
+    collector.collect(budget, names)
@@ -1,22 +1,99 @@
+import json
 import logging
+import math
+import Queue
 import socket
+import time
+import urlparse
+import zlib
 
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
-from lib.prometheus_client import generate_latest, core
+from lib.prometheus_client import choose_encoder, core, Counter, REGISTRY
 import threading
-from lib.prometheus_client.exposition import CONTENT_TYPE_LATEST
 
+from lib.collect import collect_all, collector, plugin_name
+from lib.workers import workers
 from plugins import plugins
+from plugins.base_plugin import NAMESPACE
+
+connections = Counter("connections",
+                      "HTTP connections accepted.",
+                      subsystem="http",
+                      namespace=NAMESPACE)
+requests = Counter("requests",
+                   "HTTP requests served.",
+                   subsystem="http",
+                   namespace=NAMESPACE)
+reused_requests = Counter("reused_requests",
+                          "HTTP requests served on a kept alive connection.",
+                          subsystem="http",
+                          namespace=NAMESPACE)
+
 
 class MetricsRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
 
     get_handlers = dict()
 
+    # Render /metrics straight onto the socket instead of through the cache.
+    stream = False
+    compress_level = 5
+    # Render the latest registry snapshot instead of the live metrics.
+    snapshots = False
+
+    # Seconds a request may take once it started to arrive.
+    request_timeout = 5
+    # Seconds a kept alive connection may wait for its next request, and the
+    # number of requests after which it is closed. 0 disables keep-alive.
+    # An idle connection holds a worker, so keep this well below the scrape
+    # interval.
+    keepalive_timeout = 5
+    keepalive_requests = 100
+
+    def handle(self):
+        connections.inc()
+        self.requests_handled = 0
+        self.keepalive_slot = False
+
+        try:
+            self.close_connection = 1
+            self.handle_one_request()
+            while not self.close_connection:
+                self.connection.settimeout(self.keepalive_timeout)
+                self.handle_one_request()
+        finally:
+            if self.keepalive_slot:
+                self.server.release_keepalive()
+
     def do_GET(self):
-        if self.path in self.get_handlers:
-            self.get_handlers[self.path](self)
+        self.connection.settimeout(self.request_timeout)
+
+        requests.inc()
+        if self.requests_handled:
+            reused_requests.inc()
+        self.requests_handled += 1
+        if self.keepalive_timeout <= 0 or self.requests_handled >= self.keepalive_requests:
+            self.close_connection = 1
+        elif not self.close_connection and not self.keepalive_slot:
+            # Only as many connections stay open as the server has room for.
+            self.keepalive_slot = self.server.acquire_keepalive()
+            if not self.keepalive_slot:
+                self.close_connection = 1
+
+        url = urlparse.urlsplit(self.path)
+        self.query = urlparse.parse_qs(url.query)
+
+        if url.path in self.get_handlers:
+            self.get_handlers[url.path](self)
         else:
-            self.send_response(404)
+            self.send_error(404)
+
+    def send_connection_header(self):
+        """Tells the client whether the connection stays open after this response."""
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        elif self.request_version != "HTTP/1.1":
+            self.send_header("Connection", "keep-alive")
 
     def log_message(self, format, *args):
         return
@@ -33,47 +110,487 @@ class TimeoutHTTPServer(HTTPServer):
 
     def get_request(self):
         sock, addr = self.socket.accept()
-        sock.settimeout(5)
+        sock.settimeout(MetricsRequestHandler.request_timeout)
         return (sock, addr)
 
+    def acquire_keepalive(self):
+        # A single thread serves everybody, an idle connection would block it.
+        return False
+
+    def release_keepalive(self):
+        pass
+
+
+class PooledHTTPServer(TimeoutHTTPServer):
+    """Serves requests from a fixed pool of worker threads.
+
+    At most `workers` requests are handled at once and up to `queue_size`
+    accepted connections wait for a free worker. Anything beyond that is
+    answered with 503 right away. At most `keepalive` connections, always
+    fewer than `workers`, are kept open between requests, so idle scrapers
+    never hold every worker.
+    """
 
-def start_http_server(port, addr=''):
-    httpd = TimeoutHTTPServer((addr, port), MetricsRequestHandler)
+    SERVICE_UNAVAILABLE = "HTTP/1.0 503 Service Unavailable\r\n" \
+                          "Retry-After: 1\r\n" \
+                          "Content-Length: 0\r\n" \
+                          "Connection: close\r\n\r\n"
+
+    def __init__(self, server_address, handler_class, workers=4, queue_size=16, keepalive=None):
+        # Queue.Queue(0) has no bound at all, it would never shed load.
+        if queue_size < 1:
+            raise ValueError("http_queue must be at least 1, not {}".format(queue_size))
+        TimeoutHTTPServer.__init__(self, server_address, handler_class)
+
+        if keepalive is None:
+            keepalive = workers - 1
+        self.keepalive = threading.Semaphore(max(min(int(keepalive), workers - 1), 0))
+
+        self.requests = Queue.Queue(queue_size)
+        self.rejected = Counter("rejected",
+                                "Requests rejected because all workers were busy.",
+                                subsystem="http",
+                                namespace=NAMESPACE)
+
+        for _ in xrange(workers):
+            worker = threading.Thread(target=self.process_requests)
+            worker.daemon = True
+            worker.start()
+
+    def acquire_keepalive(self):
+        return self.keepalive.acquire(False)
+
+    def release_keepalive(self):
+        self.keepalive.release()
+
+    def process_request(self, request, client_address):
+        try:
+            self.requests.put_nowait((request, client_address))
+        except Queue.Full:
+            self.rejected.inc()
+            try:
+                request.sendall(self.SERVICE_UNAVAILABLE)
+            except socket.error:
+                pass
+            self.shutdown_request(request)
+
+    def process_requests(self):
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def handle_error(self, request, client_address):
+        logging.exception("Exception while serving request from {}".format(client_address[0]))
+
+
+def start_http_server(port, addr='', config=None):
+    config = config or {}
+    scrape_cache.min_age = float(config.get("cache_min_age", 0))
+    scrape_cache.compress_level = int(config.get("compress_level", 5))
+    MetricsRequestHandler.compress_level = scrape_cache.compress_level
+    MetricsRequestHandler.stream = bool(config.get("stream", False))
+    MetricsRequestHandler.snapshots = bool(config.get("snapshots", False))
+    MetricsRequestHandler.keepalive_timeout = float(config.get("keepalive_timeout", 5))
+    MetricsRequestHandler.keepalive_requests = int(config.get("keepalive_requests", 100))
+    scrape_cache.compress_min_size = int(config.get("compress_min_size", 1024))
+    collector.timeout = float(config.get("collect_timeout", 5))
+    collector.budget = float(config.get("scrape_timeout", 10))
+    collector.offset = float(config.get("scrape_timeout_offset", 0.5))
+
+    workers = int(config.get("http_workers", 4))
+    if workers > 0:
+        httpd = PooledHTTPServer((addr, port), MetricsRequestHandler,
+                                 workers=workers,
+                                 queue_size=int(config.get("http_queue", 16)),
+                                 keepalive=config.get("keepalive_connections"))
+    else:
+        httpd = TimeoutHTTPServer((addr, port), MetricsRequestHandler)
     httpd.socket.settimeout(15)
     httpd.serve_forever()
 
 
-def gzip_encode(content):
-    import StringIO
-    import gzip
-    out = StringIO.StringIO()
-    f = gzip.GzipFile(fileobj=out, mode='w', compresslevel=5)
-    f.write(content)
-    f.close()
-    return out.getvalue()
+def gzip_compressor(level=5):
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def deflate_compressor(level=5):
+    return zlib.compressobj(level)
+
+
+COMPRESSORS = {
+    "gzip": gzip_compressor,
+    "deflate": deflate_compressor,
+}
+
+
+def gzip_encode(content, level=5):
+    compressor = gzip_compressor(level)
+    return compressor.compress(content) + compressor.flush()
+
+
+def deflate_encode(content, level=5):
+    return zlib.compress(content, level)
+
+
+ENCODERS = {
+    "gzip": gzip_encode,
+    "deflate": deflate_encode,
+}
+
+# Preferred order when the client weights several encodings the same.
+ENCODING_PREFERENCE = ["gzip", "deflate", "identity"]
+
+
+def negotiate_encoding(accept_encoding):
+    """Picks a content coding for the given Accept-Encoding header value."""
+    if not accept_encoding:
+        return "identity"
+
+    weights = {}
+    for item in accept_encoding.split(","):
+        parts = item.split(";")
+        coding = parts[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in parts[1:]:
+            key, _, value = param.strip().partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[coding] = q
+
+    def weight(coding):
+        if coding in weights:
+            return weights[coding]
+        if "*" in weights:
+            return weights["*"]
+        # identity is acceptable unless refused explicitly.
+        return 0.001 if coding == "identity" else 0.0
+
+    best = max(ENCODING_PREFERENCE, key=lambda c: (weight(c), -ENCODING_PREFERENCE.index(c)))
+    if weight(best) <= 0:
+        # Nothing acceptable, identity is still the most useful answer.
+        return "identity"
+    return best
+
+
+def selected_registry(names):
+    registry = core.REGISTRY
+    if MetricsRequestHandler.snapshots:
+        # Collections publish what they read, scrapes only read.
+        registry = registry.snapshot()
+    if names is None:
+        return registry
+    return registry.restricted_registry(names)
+
+
+def render_metrics(budget, names, generate):
+    collect_all(budget, names)
+
+    return b"".join(generate(selected_registry(names)))
+
+
+class RenderedBody(object):
+    """One rendered exposition and the encodings produced from it so far.
+
+    Every encoding is compressed at most once, later requests for it get
+    the same bytes.
+    """
+
+    def __init__(self, content, level=5, min_size=0):
+        self.content = content
+        self.level = level
+        self.min_size = min_size
+
+        self._lock = threading.Lock()
+        self._encoded = {"identity": content}
+
+    def encode(self, encoding):
+        """Returns (encoding, body), falling back to identity for small bodies."""
+        if encoding not in ENCODERS or len(self.content) < self.min_size:
+            return "identity", self.content
+
+        with self._lock:
+            if encoding not in self._encoded:
+                self._encoded[encoding] = ENCODERS[encoding](self.content, self.level)
+            return encoding, self._encoded[encoding]
+
+
+class CacheEntry(object):
+
+    def __init__(self):
+        self.body = None
+        self.created = 0
+        self.generation = 0
+        self.in_flight = False
+
 
+class ScrapeCache(object):
+    """Keeps the last rendered /metrics body for every collector selection.
 
-def collect_all():
-    for plugin in plugins:
+    A body younger than min_age seconds is served as is. Scrapes arriving
+    while a collection is running wait for it and share its result instead
+    of collecting again.
+    """
+
+    def __init__(self, render, min_age=0, compress_level=5, compress_min_size=0):
+        self.render = render
+        self.min_age = min_age
+        self.compress_level = compress_level
+        self.compress_min_size = compress_min_size
+
+        self._cond = threading.Condition(threading.Lock())
+        self._entries = {}
+
+        self.hits = Counter("cache_hits",
+                            "Scrapes served from the cached body.",
+                            subsystem="scrape",
+                            namespace=NAMESPACE)
+        self.misses = Counter("cache_misses",
+                              "Scrapes which had to collect and render.",
+                              subsystem="scrape",
+                              namespace=NAMESPACE)
+
+    def _fresh(self, entry, now):
+        return entry.body is not None and now - entry.created < self.min_age
+
+    def get(self, budget=None, names=None, content_type=None, generate=None):
+        """Returns the RenderedBody for the selected collectors (None is all).
+
+        generate renders a registry in the format of content_type, see
+        choose_encoder().
+        """
+        if generate is None:
+            content_type, generate = choose_encoder(None)
+
+        key = (names, content_type)
+        with self._cond:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = CacheEntry()
+
+            while True:
+                if self._fresh(entry, time.time()):
+                    self.hits.inc()
+                    return entry.body
+
+                if not entry.in_flight:
+                    break
+
+                generation = entry.generation
+                while entry.in_flight:
+                    self._cond.wait()
+
+                if entry.generation != generation:
+                    self.hits.inc()
+                    return entry.body
+
+                # The collection we waited for failed, try on our own.
+
+            entry.in_flight = True
+
+        self.misses.inc()
+        body = None
         try:
-            plugin.collect()
-        except Exception as e:
-            logging.error("Exception {} in {} while collecting".format(str(e), str(plugin.__class__.__name__)))
+            body = RenderedBody(self.render(budget, names, generate),
+                                level=self.compress_level,
+                                min_size=self.compress_min_size)
+        finally:
+            with self._cond:
+                if body is not None:
+                    entry.body = body
+                    entry.created = time.time()
+                    entry.generation += 1
+                entry.in_flight = False
+                self._prune(key)
+                self._cond.notify_all()
+
+        return body
+
+    def _prune(self, keep):
+        # Forget selections and formats nobody asked for since they expired.
+        now = time.time()
+        for key, entry in self._entries.items():
+            if key != keep and not entry.in_flight and not self._fresh(entry, now):
+                del self._entries[key]
+
+
+scrape_cache = ScrapeCache(render_metrics)
+
+
+def scrape_budget(request):
+    """Collection budget from the scraper's X-Prometheus-Scrape-Timeout-Seconds."""
+    timeout = request.headers.get("X-Prometheus-Scrape-Timeout-Seconds")
+    if not timeout:
+        return None
+    try:
+        # Keep part of the scraper's timeout for rendering and sending.
+        return max(float(timeout) - collector.offset, 0)
+    except ValueError:
+        return None
+
+
+def selected_collectors(request):
+    """Collector names picked by collect[] and exclude[], or None for all."""
+    collect = request.query.get("collect[]")
+    exclude = request.query.get("exclude[]")
+    if not collect and not exclude:
+        return None
+
+    known = set(plugin_name(plugin) for plugin in plugins)
+    known |= set(worker.name for worker in workers.workers)
+    unknown = set(collect or []) - known
+    unknown |= set(exclude or []) - known
+    if unknown:
+        raise ValueError("unknown collectors: {}".format(", ".join(sorted(unknown))))
+
+    names = set(collect) if collect else known
+    return frozenset(names - set(exclude or []))
+
+
+class ChunkedWriter(object):
+    """Writes a response body with chunked transfer encoding."""
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, data):
+        if data:
+            self.wfile.write("%x\r\n%s\r\n" % (len(data), data))
+
+    def close(self):
+        self.wfile.write("0\r\n\r\n")
+
+
+class StreamingBody(object):
+    """Compresses chunks as they come and passes them on to a writer."""
+
+    def __init__(self, writer, encoding, level=5):
+        self.writer = writer
+        self.compressor = None
+        if encoding in COMPRESSORS:
+            self.compressor = COMPRESSORS[encoding](level)
+
+    def write(self, data):
+        if self.compressor:
+            data = self.compressor.compress(data)
+        self.writer.write(data)
+
+    def close(self):
+        if self.compressor:
+            self.writer.write(self.compressor.flush())
+        if hasattr(self.writer, "close"):
+            self.writer.close()
+
+
+def stream_metrics(request, names, encoding, content_type, generate):
+    """Collects and writes /metrics family by family, without buffering the body."""
+    collect_all(scrape_budget(request), names)
+
+    # Chunked framing is HTTP/1.1 only, older clients read until close.
+    chunked = request.request_version == "HTTP/1.1"
+    if not chunked:
+        request.close_connection = 1
+
+    request.send_response(200)
+
+    request.send_header('Content-Type', content_type)
+    if encoding != "identity":
+        request.send_header("Content-Encoding", encoding)
+    request.send_header("Vary", "Accept, Accept-Encoding")
+    if chunked:
+        request.send_header("Transfer-Encoding", "chunked")
+    request.send_connection_header()
+    request.end_headers()
+
+    writer = ChunkedWriter(request.wfile) if chunked else request.wfile
+    body = StreamingBody(writer, encoding, request.compress_level)
+    for chunk in generate(selected_registry(names)):
+        body.write(chunk)
+    body.close()
 
 
 @MetricsRequestHandler.route("/metrics")
 def metrics_handler(request):
+    try:
+        names = selected_collectors(request)
+    except ValueError as e:
+        request.send_error(400, str(e))
+        return
+
+    content_type, generate = choose_encoder(request.headers.get("Accept"))
+    encoding = negotiate_encoding(request.headers.get("Accept-Encoding"))
+    if request.stream:
+        stream_metrics(request, names, encoding, content_type, generate)
+        return
+
+    body = scrape_cache.get(scrape_budget(request), names, content_type, generate)
+    encoding, content = body.encode(encoding)
+
     request.send_response(200)
 
-    request.send_header('Content-Type', CONTENT_TYPE_LATEST)
-    request.send_header("Content-Encoding", "gzip")
+    request.send_header('Content-Type', content_type)
+    if encoding != "identity":
+        request.send_header("Content-Encoding", encoding)
+    request.send_header("Vary", "Accept, Accept-Encoding")
+    request.send_header("Content-Length", str(len(content)))
+    request.send_connection_header()
     request.end_headers()
 
-    collect_all()
+    request.wfile.write(content)
 
-    content = generate_latest(core.REGISTRY)
-    content = gzip_encode(content)
 
-    request.wfile.write(content)
+def json_value(value):
+    """JSON has no NaN and infinities, those are sent as in the text format."""
+    if math.isnan(value) or math.isinf(value):
+        return core._floatToGoString(value)
+    return value
 
 
+@MetricsRequestHandler.route("/api/v1/sample")
+def sample_handler(request):
+    """Answers with the samples of one metric as JSON, e.g.
+
+        /api/v1/sample?name=node_netdev_rx_bytes&label=device=eth0
+
+    Every label parameter is a name=value pair the samples must have.
+    Plugins collected on scrape are collected first if they own the metric.
+    """
+    name = request.query.get("name", [None])[0]
+    if not name:
+        request.send_error(400, "Missing name")
+        return
+
+    labels = {}
+    for label in request.query.get("label", []):
+        if "=" not in label:
+            request.send_error(400, "Label must be name=value: {}".format(label))
+            return
+        label_name, value = label.split("=", 1)
+        labels[label_name] = value.decode("utf-8", "replace")
+
+    owners = frozenset(owner for owner in REGISTRY.owners_of(name) if owner is not None)
+    if owners:
+        collect_all(scrape_budget(request), owners)
+
+    # Answers from the same snapshot /metrics renders.
+    registry = REGISTRY.snapshot() if MetricsRequestHandler.snapshots else REGISTRY
+    samples = [{"name": n, "labels": l, "value": json_value(v)}
+               for n, l, v in registry.get_samples(name, labels)]
+    content = json.dumps(samples, separators=(",", ":"))
+
+    request.send_response(200)
+    request.send_header("Content-Type", "application/json")
+    request.send_header("Content-Length", str(len(content)))
+    request.send_connection_header()
+    request.end_headers()
+
+    request.wfile.write(content)
@@ -0,0 +1,168 @@
+import socket
+import struct
+import threading
+
+NETLINK_ROUTE = 0
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+RTM_NEWLINK = 16
+RTM_GETLINK = 18
+
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+
+IFLA_IFNAME = 3
+IFLA_OPERSTATE = 16
+IFLA_STATS64 = 23
+IFLA_CARRIER = 33
+
+IFF_UP = 0x1
+
+# RFC 2863 operational states, as in IFLA_OPERSTATE.
+OPERSTATES = ("unknown", "notpresent", "down", "lowerlayerdown", "testing", "dormant", "up")
+OPERSTATE_UP = 6
+
+_NLMSGHDR = struct.Struct("=IHHII")
+_IFINFOMSG = struct.Struct("=BxHiII")
+_RTATTR = struct.Struct("=HH")
+_NLMSGERR = struct.Struct("=i")
+# The fields of struct rtnl_link_stats64 every kernel with it has, newer
+# ones append more.
+STATS64_FIELDS = ("rx_packets", "tx_packets", "rx_bytes", "tx_bytes", "rx_errors", "tx_errors",
+                  "rx_dropped", "tx_dropped", "multicast", "collisions",
+                  "rx_length_errors", "rx_over_errors", "rx_crc_errors", "rx_frame_errors",
+                  "rx_fifo_errors", "rx_missed_errors",
+                  "tx_aborted_errors", "tx_carrier_errors", "tx_fifo_errors",
+                  "tx_heartbeat_errors", "tx_window_errors",
+                  "rx_compressed", "tx_compressed")
+_STATS64 = struct.Struct("=%dQ" % len(STATS64_FIELDS))
+
+_WANTED = frozenset((IFLA_IFNAME, IFLA_OPERSTATE, IFLA_STATS64, IFLA_CARRIER))
+
+
+class Link(object):
+    __slots__ = ("name", "flags", "operstate", "carrier", "stats")
+
+    def __init__(self, name, flags, operstate, carrier, stats):
+        self.name = name
+        self.flags = flags
+        # Index into OPERSTATES.
+        self.operstate = operstate
+        self.carrier = carrier
+        # Values in the order of STATS64_FIELDS, None if the kernel sent none.
+        self.stats = stats
+
+
+class RouteSocket(object):
+    """A NETLINK_ROUTE socket kept open for link dumps.
+
+    links() asks the kernel for all interfaces at once with a single
+    RTM_GETLINK dump, with 64 bit counters for each, instead of reading a
+    file per interface. Replies are received into a buffer that is reused.
+    A socket that fails is opened again on the next dump.
+    """
+
+    def __init__(self, size=65536, timeout=5.0):
+        self.timeout = timeout
+
+        self._socket = None
+        self._seq = 0
+        self._buffer = bytearray(size)
+        self._lock = threading.Lock()
+
+    def _open(self):
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        sock.bind((0, 0))
+        sock.settimeout(self.timeout)
+        return sock
+
+    def close(self):
+        with self._lock:
+            if self._socket is not None:
+                self._socket.close()
+                self._socket = None
+
+    def links(self):
+        with self._lock:
+            try:
+                if self._socket is None:
+                    self._socket = self._open()
+                return self._dump()
+            except (socket.error, IOError):
+                if self._socket is not None:
+                    self._socket.close()
+                    self._socket = None
+                raise
+
+    def _dump(self):
+        self._seq += 1
+        request = _NLMSGHDR.pack(_NLMSGHDR.size + _IFINFOMSG.size, RTM_GETLINK,
+                                 NLM_F_REQUEST | NLM_F_DUMP, self._seq, 0)
+        self._socket.send(request + _IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0))
+
+        links = []
+        while True:
+            n = self._socket.recv_into(self._buffer)
+            pos = 0
+            while pos + _NLMSGHDR.size <= n:
+                length, typ, _, seq, _ = _NLMSGHDR.unpack_from(self._buffer, pos)
+                if length < _NLMSGHDR.size:
+                    raise IOError("Malformed netlink message")
+                if seq != self._seq:
+                    # Left over from an earlier dump that was given up on.
+                    pass
+                elif typ == NLMSG_DONE:
+                    return links
+                elif typ == NLMSG_ERROR:
+                    error = _NLMSGERR.unpack_from(self._buffer, pos + _NLMSGHDR.size)[0]
+                    raise IOError(-error, "RTM_GETLINK failed")
+                elif typ == RTM_NEWLINK:
+                    link = self._link(pos + _NLMSGHDR.size, min(pos + length, n))
+                    if link is not None:
+                        links.append(link)
+                pos += (length + 3) & ~3
+
+    def _link(self, pos, end):
+        buf = self._buffer
+        unpack_attr = _RTATTR.unpack_from
+        if pos + _IFINFOMSG.size > end:
+            return None
+        _, _, _, flags, _ = _IFINFOMSG.unpack_from(buf, pos)
+        pos += _IFINFOMSG.size
+
+        # Offsets of the wanted attributes, cut at the end of the message.
+        # The walk stops once all are found, before the large nested
+        # attributes that come last.
+        found = {}
+        while pos + _RTATTR.size <= end:
+            length, typ = unpack_attr(buf, pos)
+            if length < _RTATTR.size:
+                break
+            if typ in _WANTED:
+                found[typ] = (pos + _RTATTR.size, min(pos + length, end))
+                if len(found) == len(_WANTED):
+                    break
+            pos += (length + 3) & ~3
+
+        name = None
+        if IFLA_IFNAME in found:
+            start, stop = found[IFLA_IFNAME]
+            name = memoryview(buf)[start:stop].tobytes().rstrip("\0")
+        operstate = 0
+        if IFLA_OPERSTATE in found:
+            start, stop = found[IFLA_OPERSTATE]
+            if stop > start:
+                operstate = buf[start]
+        carrier = None
+        if IFLA_CARRIER in found:
+            start, stop = found[IFLA_CARRIER]
+            if stop > start:
+                carrier = buf[start]
+        stats = None
+        if IFLA_STATS64 in found:
+            start, stop = found[IFLA_STATS64]
+            if stop - start >= _STATS64.size:
+                stats = _STATS64.unpack_from(buf, start)
+
+        return Link(name, flags, operstate, carrier, stats)
@@ -0,0 +1,117 @@
+import errno
+import io
+import re
+import select
+import threading
+
+
+class ProcFile(object):
+    """A file of /proc or /sys that is opened once and read many times.
+
+    The kernel builds the contents of these files again on every read from
+    the start, so instead of open, fstat, read and close on each collection
+    the file is kept open and read with a seek to 0 into a buffer that is
+    reused and only grows. Reads go on until one returns nothing: the
+    kernel hands out large files a page at a time, so a short read is not
+    the end of the file. read() returns the contents as a string.
+    """
+
+    def __init__(self, path, size=4096):
+        self.path = path
+
+        self._file = None
+        self._buffer = bytearray(size)
+        self._lock = threading.Lock()
+
+    def read(self):
+        with self._lock:
+            try:
+                if self._file is None:
+                    self._file = io.open(self.path, "rb", buffering=0)
+                self._file.seek(0)
+
+                used = 0
+                while True:
+                    if used == len(self._buffer):
+                        self._buffer.extend(bytearray(len(self._buffer)))
+                    n = self._file.readinto(memoryview(self._buffer)[used:])
+                    if not n:
+                        break
+                    used += n
+            except IOError as e:
+                # EINVAL is an attribute without a value right now, like the
+                # carrier of an interface that is down. Anything else may be
+                # a file that is gone, open it again on the next read.
+                if e.errno != errno.EINVAL:
+                    self._close()
+                raise
+
+            return memoryview(self._buffer)[:used].tobytes()
+
+    def fileno(self):
+        """The descriptor of the open file, None before the first read."""
+        return None if self._file is None else self._file.fileno()
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+
+class ProcFiles(object):
+    """ProcFiles by path, for sets of files that come and go, like per device."""
+
+    def __init__(self, size=4096):
+        self.size = size
+        self._files = {}
+
+    def read(self, path):
+        if path not in self._files:
+            self._files[path] = ProcFile(path, self.size)
+        return self._files[path].read()
+
+    def retain(self, paths):
+        """Closes the files not in paths."""
+        for path in set(self._files) - set(paths):
+            self._files.pop(path).close()
+
+
+_ESCAPE = re.compile(r"\\([0-7]{3})")
+
+
+class MountTable(ProcFile):
+    """/proc/self/mounts, with a cheap way to tell whether it changed.
+
+    The kernel flags an open mounts file with POLLPRI and POLLERR once a
+    mount is added or removed, and the poll that reports it clears the
+    flag. changed() is that poll without waiting, one syscall.
+    """
+
+    def __init__(self, path="/proc/self/mounts"):
+        super(MountTable, self).__init__(path, size=16384)
+        self._poll = None
+        self._fd = None
+
+    def changed(self):
+        if self._poll is None:
+            return True
+        return bool(self._poll.poll(0))
+
+    def mountpoints(self):
+        """Reads the table and returns its mountpoints."""
+        data = self.read()
+
+        # A file opened again after an error has to be watched again.
+        fd = self.fileno()
+        if fd != self._fd:
+            self._poll = select.poll()
+            self._poll.register(fd, select.POLLPRI | select.POLLERR)
+            self._fd = fd
+
+        # Spaces and the like are written as octal escapes.
+        return [_ESCAPE.sub(lambda m: chr(int(m.group(1), 8)), line.split()[1])
+                for line in data.splitlines()]
@@ -18,7 +18,15 @@ Summary = core.Summary
 Histogram = core.Histogram
 
 CONTENT_TYPE_LATEST = exposition.CONTENT_TYPE_LATEST
+CONTENT_TYPE_OPENMETRICS = exposition.CONTENT_TYPE_OPENMETRICS
+CONTENT_TYPE_PROTOBUF = exposition.CONTENT_TYPE_PROTOBUF
 generate_latest = exposition.generate_latest
+generate_latest_chunks = exposition.generate_latest_chunks
+generate_openmetrics = exposition.generate_openmetrics
+generate_openmetrics_chunks = exposition.generate_openmetrics_chunks
+generate_protobuf = exposition.generate_protobuf
+generate_protobuf_chunks = exposition.generate_protobuf_chunks
+choose_encoder = exposition.choose_encoder
 MetricsHandler = exposition.MetricsHandler
 start_http_server = exposition.start_http_server
 write_to_textfile = exposition.write_to_textfile
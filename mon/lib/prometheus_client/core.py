@@ -3,9 +3,12 @@
 from __future__ import unicode_literals
 
 import copy
+import itertools
+import math
+from array import array
+from bisect import bisect_left
 import re
 import time
-import types
 
 try:
     from BaseHTTPServer import BaseHTTPRequestHandler
@@ -13,15 +16,31 @@ except ImportError:
     # Python 3
     unicode = str
 
+from contextlib import contextmanager
 from functools import wraps
-from threading import Lock
+from threading import Lock, local
 
 _METRIC_NAME_RE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*$')
 _METRIC_LABEL_NAME_RE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*$')
 _RESERVED_METRIC_LABEL_NAME_RE = re.compile(r'^__.*$')
 _INF = float("inf")
+# Suffixes of the samples of summaries and histograms.
+_SAMPLE_SUFFIXES = ('_count', '_sum', '_bucket')
+# Label value of the series that takes the updates of label sets over the limit.
+OVERFLOW_LABEL_VALUE = '__overflow__'
 _MINUS_INF = float("-inf")
 
+# Children share a small pool of locks instead of allocating one each, and
+# label maps lock one stripe per label set when adding a child.
+_VALUE_LOCKS = tuple(Lock() for _ in range(64))
+_MAP_LOCKS = tuple(Lock() for _ in range(16))
+_next_value_lock = itertools.count()
+
+
+def _value_lock():
+    '''Returns a lock for a new child, handing out the pool in turn.'''
+    return _VALUE_LOCKS[next(_next_value_lock) % len(_VALUE_LOCKS)]
+
 
 class CollectorRegistry(object):
     '''Metric collector registry.
@@ -32,41 +51,232 @@ class CollectorRegistry(object):
     '''
     def __init__(self):
         self._collectors = set()
+        self._owners = {}
+        self._limits = {}
+        self._columnar = set()
+        # Metric name to collectors, built on the first lookup.
+        self._index = None
+        self._scope = local()
         self._lock = Lock()
+        self._snapshot = None
+        self._epoch = 0
+        self._publish_lock = Lock()
+
+    @contextmanager
+    def owner(self, name):
+        '''Attribute collectors registered by this thread in the block to name.
+
+        Used with restricted_registry() to render only some owners.
+        '''
+        previous = getattr(self._scope, 'owner', None)
+        self._scope.owner = name
+        try:
+            yield
+        finally:
+            self._scope.owner = previous
 
     def register(self, collector):
         '''Add a collector to the registry.'''
+        owner = getattr(self._scope, 'owner', None)
         with self._lock:
             self._collectors.add(collector)
+            self._index = None
+            if owner is not None:
+                self._owners[collector] = owner
+                if owner in self._limits and hasattr(collector, '_limit'):
+                    collector._limit(*self._limits[owner])
 
     def unregister(self, collector):
         '''Remove a collector from the registry.'''
         with self._lock:
             self._collectors.remove(collector)
+            self._owners.pop(collector, None)
+            self._index = None
 
-    def collect(self):
-        '''Yields metrics from the collectors in the registry.'''
+    def collect(self, owners=None, unowned=True):
+        '''Yields metrics from the collectors in the registry.
+
+        If owners is given, collectors registered under another owner are
+        skipped. Collectors without an owner are included unless unowned
+        is False.
+        '''
         collectors = None
         with self._lock:
-            collectors = copy.copy(self._collectors)
+            if owners is None:
+                collectors = copy.copy(self._collectors)
+            else:
+                collectors = [c for c in self._collectors
+                              if (unowned and self._owners.get(c, None) is None) or self._owners.get(c, None) in owners]
         for collector in collectors:
             for metric in collector.collect():
                 yield metric
 
-    def get_sample_value(self, name, labels=None):
-        '''Returns the sample value, or None if not found.
+    def expire(self, owner, ttl=None):
+        '''Ends a collection cycle of owner, returns how many children were evicted.
+
+        Labeled metrics of owner drop the children that were not looked up
+        for ttl cycles in a row. Metrics created with their own ttl use that.
+        '''
+        with self._lock:
+            collectors = [c for c in self._collectors if self._owners.get(c, None) == owner]
+        evicted = 0
+        for collector in collectors:
+            if hasattr(collector, '_expire'):
+                evicted += collector._expire(ttl)
+        return evicted
+
+    def limit(self, owner, max_children, overflow=True):
+        '''Caps the number of children of every labeled metric of owner.
+
+        Also applies to metrics owner registers later. Metrics created with
+        their own max_children keep it. See _LabelWrapper for the policies.
+        '''
+        with self._lock:
+            self._limits[owner] = (max_children, overflow)
+            collectors = [c for c in self._collectors if self._owners.get(c, None) == owner]
+        for collector in collectors:
+            if hasattr(collector, '_limit'):
+                collector._limit(max_children, overflow)
 
-        This is inefficient, and intended only for use in unittests.
+    def columnar(self, owner):
+        '''Stores the labeled counters and gauges owner creates from now on in columns.
+
+        Metrics created with columnar=True or False keep their choice.
+        '''
+        with self._lock:
+            self._columnar.add(owner)
+
+    def _columnar_scope(self):
+        owner = getattr(self._scope, 'owner', None)
+        return owner is not None and owner in self._columnar
+
+    def rejected(self, owner):
+        '''Returns how many lookups of new label sets the limits of owner refused.'''
+        with self._lock:
+            collectors = [c for c in self._collectors if self._owners.get(c, None) == owner]
+        return sum(getattr(c, '_rejected', 0) for c in collectors)
+
+    def publish(self, owners=None, unowned=True):
+        '''Reads collectors into a new snapshot and makes it the current one.
+
+        With owners, only the collectors of those owners (and the unowned
+        ones, unless unowned is False) are read again, the metrics of the
+        others are taken over from the current snapshot. The snapshot is
+        built aside while the current one is still being read, then
+        published with a single store.
+        '''
+        with self._lock:
+            collectors = [(c, self._owners.get(c, None)) for c in self._collectors
+                          if owners is None or (unowned and self._owners.get(c, None) is None)
+                          or self._owners.get(c, None) in owners]
+        metrics = {}
+        for collector, owner in collectors:
+            metrics.setdefault(owner, []).extend(_freeze(metric) for metric in collector.collect())
+        with self._publish_lock:
+            if owners is not None and self._snapshot is not None:
+                # Owners that were read again replace their metrics, also
+                # when none are left.
+                for owner, frozen in self._snapshot._metrics.items():
+                    if owner not in metrics and not ((unowned and owner is None) or owner in owners):
+                        metrics[owner] = frozen
+            snapshot = _Snapshot(self._epoch + 1, time.time(), metrics)
+            self._epoch = snapshot.epoch
+            self._snapshot = snapshot
+        return snapshot
+
+    def snapshot(self):
+        '''Returns the last published snapshot, publishing one if there is none yet.'''
+        snapshot = self._snapshot
+        if snapshot is None:
+            snapshot = self.publish()
+        return snapshot
+
+    def snapshots(self):
+        '''Returns a view that renders the latest snapshot, for pushing readers.'''
+        return _SnapshotView(self)
+
+    def restricted_registry(self, owners):
+        '''Returns a view of the registry with only the given owners.'''
+        return _RestrictedRegistry(self, frozenset(owners))
+
+    def _families(self, name):
+        '''Returns (metric name, collector) of the metrics the samples named name belong to.'''
+        with self._lock:
+            index = self._index
+            collectors = copy.copy(self._collectors)
+        if index is None:
+            # Only our own metrics have fixed names, other collectors are
+            # asked on every lookup.
+            index = {None: []}
+            for collector in collectors:
+                for metric in collector.collect():
+                    if isinstance(metric, _CollectorMetric):
+                        index.setdefault(metric._name, []).append(collector)
+                    elif collector not in index[None]:
+                        index[None].append(collector)
+            with self._lock:
+                if self._collectors == collectors:
+                    self._index = index
+
+        families = []
+        for collector in index[None]:
+            for metric in collector.collect():
+                if metric._name == name or any(name == metric._name + suffix for suffix in _SAMPLE_SUFFIXES):
+                    families.append((metric._name, collector))
+        if name in index:
+            return families + [(name, c) for c in index[name]]
+        for suffix in _SAMPLE_SUFFIXES:
+            if name.endswith(suffix) and name[:-len(suffix)] in index:
+                family = name[:-len(suffix)]
+                return families + [(family, c) for c in index[family]]
+        return families
+
+    def owners_of(self, name):
+        '''Returns the owners of the metrics with samples named name, None for unowned ones.'''
+        families = self._families(name)
+        with self._lock:
+            return set(self._owners.get(c, None) for _, c in families)
+
+    def get_samples(self, name, labels=None):
+        '''Returns (name, labels, value) of the samples named name that have all the given labels.
+
+        name may also be the name of a summary or histogram, which selects
+        all of its samples. Only the metrics of that name are looked at.
         '''
         if labels is None:
             labels = {}
-        for metric in self.collect():
-            for n, l, value in metric._samples:
-                if n == name and l == labels:
-                    return value
+        samples = []
+        for family, collector in self._families(name):
+            for metric in collector.collect():
+                if metric._name != family:
+                    continue
+                if hasattr(metric, '_select'):
+                    selected = metric._select(labels)
+                else:
+                    selected = [sample for sample in metric._samples
+                                if all(sample[1].get(l) == v for l, v in labels.items())]
+                samples.extend(sample for sample in selected if name in (family, sample[0]))
+        return samples
+
+    def get_sample_value(self, name, labels=None):
+        '''Returns the sample value, or None if not found.'''
+        if labels is None:
+            labels = {}
+        for n, l, value in self.get_samples(name, labels):
+            if n == name and l == labels:
+                return value
         return None
 
 
+class _RestrictedRegistry(object):
+    def __init__(self, registry, owners):
+        self._registry = registry
+        self._owners = owners
+
+    def collect(self):
+        return self._registry.collect(self._owners)
+
+
 REGISTRY = CollectorRegistry()
 '''The default registry.'''
 
@@ -88,15 +298,203 @@ class Metric(object):
         self._samples.append((name, labels, value))
 
 
+class _CollectorMetric(Metric):
+    '''A metric read from one of our own collectors.
+
+    Samples are only built when asked for. The text format is rendered by
+    the collector, which keeps the lines of series that did not change.
+    '''
+    def __init__(self, name, documentation, typ, samples, render, header, select):
+        self._name = name
+        self._documentation = documentation
+        self._type = typ
+        self._samples_of = samples
+        self._render = render
+        self._header = header
+        self._select_of = select
+
+    @property
+    def _samples(self):
+        return [(self._name + suffix, labels, value) for suffix, labels, value in self._samples_of()]
+
+    def _render_text(self):
+        '''Returns the family in latest text format, utf-8 encoded.'''
+        output = [self._header]
+        self._render(self._name, output)
+        return b''.join(output)
+
+    def _select(self, labels):
+        '''Returns the samples that have all the given labels.'''
+        return [(self._name + suffix, sample_labels, value)
+                for suffix, sample_labels, value in self._select_of(labels)]
+
+    def _freeze(self):
+        # Text and samples come from the same read of every child.
+        output = [self._header]
+        samples = []
+        self._render(self._name, output, samples)
+        return _SnapshotMetric(self._name, self._documentation, self._type, samples, b''.join(output))
+
+
+class _SnapshotMetric(Metric):
+    '''A metric as it was when its snapshot was taken, with its text rendered.'''
+    def __init__(self, name, documentation, typ, samples, text):
+        self._name = name
+        self._documentation = documentation
+        self._type = typ
+        self._samples = samples
+        self._text = text
+
+    def _render_text(self):
+        return self._text
+
+
+def _freeze(metric):
+    '''Returns an unchanging copy of a metric from any collector.'''
+    if isinstance(metric, _CollectorMetric):
+        return metric._freeze()
+    samples = list(metric._samples)
+    output = [_render_header(metric._name, metric._documentation, metric._type)]
+    for name, labels, value in samples:
+        output.append('{0}{1} {2}\n'.format(name, _render_labels(labels), _floatToGoString(value)).encode('utf-8'))
+    return _SnapshotMetric(metric._name, metric._documentation, metric._type, samples, b''.join(output))
+
+
+class _Snapshot(object):
+    '''The metrics of a registry at one point in time.
+
+    Published snapshots never change, so any number of readers can render
+    them without locks. epoch counts the snapshots of the registry.
+    '''
+    def __init__(self, epoch, timestamp, metrics):
+        self.epoch = epoch
+        self.timestamp = timestamp
+        # Frozen metrics by owner.
+        self._metrics = metrics
+
+    def collect(self, owners=None, unowned=True):
+        '''Returns the metrics, like CollectorRegistry.collect().'''
+        return [metric for owner, frozen in self._metrics.items()
+                if owners is None or (unowned and owner is None) or owner in owners
+                for metric in frozen]
+
+    def get_samples(self, name, labels=None):
+        '''Returns the samples named name, like CollectorRegistry.get_samples().'''
+        if labels is None:
+            labels = {}
+        samples = []
+        for metric in self.collect():
+            family = metric._name
+            if name != family and not any(name == family + suffix for suffix in _SAMPLE_SUFFIXES):
+                continue
+            samples.extend(sample for sample in metric._samples
+                           if name in (family, sample[0])
+                           and all(sample[1].get(l) == v for l, v in labels.items()))
+        return samples
+
+    def restricted_registry(self, owners):
+        return _RestrictedRegistry(self, frozenset(owners))
+
+
+class _SnapshotView(object):
+    '''A registry that always reads the latest snapshot of another.'''
+    def __init__(self, registry):
+        self._registry = registry
+
+    def collect(self):
+        return self._registry.snapshot().collect()
+
+
+def _escape_help(documentation):
+    return documentation.replace('\\', r'\\').replace('\n', r'\n')
+
+
+def _render_labels(labels):
+    '''Returns the {k="v",...} part of a sample line, empty without labels.'''
+    if not labels:
+        return ''
+    return '{{{0}}}'.format(','.join(
+        ['{0}="{1}"'.format(
+         k, v.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"'))
+         for k, v in sorted(labels.items())]))
+
+
+def _render_header(name, documentation, typ):
+    return '# HELP {0} {1}\n# TYPE {0} {2}\n'.format(
+        name, _escape_help(documentation), typ).encode('utf-8')
+
+
+def _render_child(child, full_name, labelnames, labelvalues, output, snapshot=None):
+    '''Appends the text lines of one child to output.
+
+    The name{labels} prefix of every sample is rendered once per child, and
+    a line is formatted again only when its value changed. With snapshot,
+    the samples that were rendered are appended to it too.
+    '''
+    samples = child._samples()
+    if snapshot is not None:
+        series_labels = dict(zip(labelnames, labelvalues))
+        for suffix, sample_labels, value in samples:
+            labels = series_labels.copy()
+            labels.update(sample_labels)
+            snapshot.append((full_name + suffix, labels, value))
+    cache = child._text_cache
+    if cache is None or len(cache) != len(samples):
+        series_labels = dict(zip(labelnames, labelvalues))
+        cache = []
+        for suffix, sample_labels, _ in samples:
+            labels = series_labels.copy()
+            labels.update(sample_labels)
+            cache.append((full_name + suffix + _render_labels(labels), None, None))
+        child._text_cache = cache
+
+    for i, sample in enumerate(samples):
+        prefix, last, line = cache[i]
+        value = sample[2]
+        if line is None or last != value:
+            line = '{0} {1}\n'.format(prefix, _floatToGoString(value)).encode('utf-8')
+            # One store, so concurrent renders never pair a value with another line.
+            cache[i] = (prefix, value, line)
+        output.append(line)
+
+
+def _label_tuple(labelnames, labelvalues):
+    '''Returns the label values given to labels() as a tuple of unicode.'''
+    if len(labelvalues) == 1 and type(labelvalues[0]) == dict:
+        if sorted(labelvalues[0].keys()) != sorted(labelnames):
+            raise ValueError('Incorrect label names')
+        return tuple([unicode(labelvalues[0][l]) for l in labelnames])
+    if len(labelvalues) != len(labelnames):
+        raise ValueError('Incorrect label count')
+    return tuple([unicode(l) for l in labelvalues])
+
+
 class _LabelWrapper(object):
-    '''Handles labels for the wrapped metric.'''
-    def __init__(self, wrappedClass, labelnames, **kwargs):
+    '''Handles labels for the wrapped metric.
+
+    With max_children set, label sets beyond that many are refused. With
+    overflow they all share one series whose label values are
+    OVERFLOW_LABEL_VALUE; without it their updates are discarded. Either
+    way the refusal is counted in _rejected. Threads adding children at
+    the same time may overshoot the limit by a few.
+    '''
+    def __init__(self, wrappedClass, labelnames, ttl=None, max_children=None, overflow=True, **kwargs):
         self._wrappedClass = wrappedClass
         self._type = wrappedClass._type
         self._labelnames = labelnames
         self._kwargs = kwargs
-        self._lock = Lock()
         self._metrics = {}
+        self._series_labels = {}
+        self._ttl = ttl
+        # Label sets looked up in the current cycle, and the number of
+        # cycles in a row the others were missed.
+        self._seen = set()
+        self._missed = {}
+        self._max_children = max_children
+        self._overflow = overflow
+        self._own_limit = max_children is not None
+        self._rejected = 0
+        self._discarded = None
 
         for l in labelnames:
             if l.startswith('__'):
@@ -112,39 +510,431 @@ class _LabelWrapper(object):
             # Set labels by name
             c.labels({'l': '0', 'm': '1'}).inc()
         '''
-        if len(labelvalues) == 1 and type(labelvalues[0]) == dict:
-            if sorted(labelvalues[0].keys()) != sorted(self._labelnames):
-                raise ValueError('Incorrect label names')
-            labelvalues = tuple([unicode(labelvalues[0][l]) for l in self._labelnames])
+        # Children are keyed by tuples of unicode, which compare and hash
+        # like tuples of ASCII str. So the common lookup needs neither a
+        # conversion nor a lock.
+        try:
+            metric = self._metrics[labelvalues]
+            self._seen.add(labelvalues)
+            return metric
+        except (KeyError, TypeError):
+            pass
+
+        labelvalues = _label_tuple(self._labelnames, labelvalues)
+        metric = self._metrics.get(labelvalues)
+        if metric is None:
+            return self._add(labelvalues)
+        self._seen.add(labelvalues)
+        return metric
+
+    def set_many(self, values, labelvalues=None):
+        '''Set the value of many children at once.
+
+        values maps label values to values, or is a sequence of values
+        parallel to the sequence labelvalues. Label values are tuples, or
+        single values for metrics with one label:
+            g = Gauge('g', 'gauge', ['l', 'm'])
+            g.set_many({('0', '1'): 1.0, ('0', '2'): 2.0})
+            g.set_many([1.0, 2.0], [('0', '1'), ('0', '2')])
+        The children are looked up first, then all of them are updated while
+        their locks are held once.
+        '''
+        if '_value' not in self._wrappedClass.__slots__:
+            raise TypeError('set_many() is only available for counters and gauges')
+        if labelvalues is None:
+            items = values.items()
         else:
-            if len(labelvalues) != len(self._labelnames):
-                raise ValueError('Incorrect label count')
-            labelvalues = tuple([unicode(l) for l in labelvalues])
-        with self._lock:
-            if labelvalues not in self._metrics:
-                self._metrics[labelvalues] = self._wrappedClass(**self._kwargs)
-            return self._metrics[labelvalues]
+            if len(values) != len(labelvalues):
+                raise ValueError('Incorrect value count')
+            items = zip(labelvalues, values)
+
+        metrics = self._metrics
+        seen = self._seen
+        updates = []
+        for key, value in items:
+            if type(key) is not tuple:
+                key = (key,)
+            child = metrics.get(key)
+            if child is None:
+                child = self.labels(*key)
+            else:
+                seen.add(key)
+            updates.append((child, float(value)))
+
+        # Pool locks are shared between children, take each once and in
+        # the same order as every other caller.
+        locks = sorted(set(child._lock for child, _ in updates), key=id)
+        for lock in locks:
+            lock.acquire()
+        try:
+            for child, value in updates:
+                child._value = value
+        finally:
+            for lock in locks:
+                lock.release()
+
+    def _limit(self, max_children, overflow):
+        if not self._own_limit:
+            self._max_children = max_children
+            self._overflow = overflow
+
+    def _add(self, labelvalues, limited=True):
+        with _MAP_LOCKS[hash(labelvalues) % len(_MAP_LOCKS)]:
+            metric = self._metrics.get(labelvalues)
+            full = limited and self._max_children is not None and len(self._metrics) >= self._max_children
+            if metric is None and not full:
+                metric = self._wrappedClass(**self._kwargs)
+                # Labels first, readers go through _metrics.
+                self._series_labels[labelvalues] = dict(zip(self._labelnames, labelvalues))
+                self._metrics[labelvalues] = metric
+        if metric is None:
+            return self._reject()
+        self._seen.add(labelvalues)
+        return metric
+
+    def _reject(self):
+        self._rejected += 1
+        if self._overflow:
+            return self._add((OVERFLOW_LABEL_VALUE,) * len(self._labelnames), limited=False)
+        if self._discarded is None:
+            self._discarded = self._wrappedClass(**self._kwargs)
+        return self._discarded
 
     def remove(self, *labelvalues):
         '''Remove the given labelset from the metric.'''
         if len(labelvalues) != len(self._labelnames):
             raise ValueError('Incorrect label count')
         labelvalues = tuple([unicode(l) for l in labelvalues])
-        with self._lock:
+        with _MAP_LOCKS[hash(labelvalues) % len(_MAP_LOCKS)]:
             del self._metrics[labelvalues]
+            del self._series_labels[labelvalues]
+        self._missed.pop(labelvalues, None)
+
+    def _expire(self, ttl=None):
+        ttl = self._ttl or ttl
+        seen, self._seen = self._seen, set()
+        if not ttl:
+            return 0
+
+        missed = self._missed
+        evicted = 0
+        for labelvalues in list(self._metrics):
+            if labelvalues in seen:
+                missed.pop(labelvalues, None)
+                continue
+            missed[labelvalues] = missed.get(labelvalues, 0) + 1
+            if missed[labelvalues] >= ttl:
+                with _MAP_LOCKS[hash(labelvalues) % len(_MAP_LOCKS)]:
+                    self._metrics.pop(labelvalues, None)
+                    self._series_labels.pop(labelvalues, None)
+                del missed[labelvalues]
+                evicted += 1
+        return evicted
 
     def _samples(self):
-        with self._lock:
-            metrics = self._metrics.copy()
-        for labels, metric in metrics.items():
-            series_labels = list(dict(zip(self._labelnames, labels)).items())
+        # Copying a dict is atomic, no lock needed for a consistent view.
+        metrics = list(self._metrics.items())
+        series_labels = self._series_labels.copy()
+        for labels, metric in metrics:
             for suffix, sample_labels, value in metric._samples():
-                yield (suffix, dict(series_labels + list(sample_labels.items())), value)
+                sample = series_labels.get(labels) or dict(zip(self._labelnames, labels))
+                sample = sample.copy()
+                sample.update(sample_labels)
+                yield (suffix, sample, value)
+
+    def _select(self, labels):
+        '''Yields the samples of the children that have all the given labels.
+
+        With a value for every label name the child is looked up directly,
+        otherwise only the label sets are scanned.
+        '''
+        series = dict((l, unicode(v)) for l, v in labels.items() if l in self._labelnames)
+        rest = dict((l, v) for l, v in labels.items() if l not in self._labelnames)
+        if len(series) == len(self._labelnames):
+            key = tuple(series[l] for l in self._labelnames)
+            metric = self._metrics.get(key)
+            children = [(key, metric)] if metric is not None else []
+        else:
+            positions = [(list(self._labelnames).index(l), v) for l, v in series.items()]
+            children = [(key, metric) for key, metric in list(self._metrics.items())
+                        if all(key[i] == v for i, v in positions)]
+        for key, metric in children:
+            for suffix, sample_labels, value in _select_samples(metric, rest):
+                sample = dict(zip(self._labelnames, key))
+                sample.update(sample_labels)
+                yield (suffix, sample, value)
+
+    def _render_text(self, full_name, output, snapshot=None):
+        metrics = list(self._metrics.items())
+        for labels, metric in metrics:
+            _render_child(metric, full_name, self._labelnames, labels, output, snapshot)
+
+
+class _ColumnarChild(object):
+    '''A series of a columnar family, borrowing the methods of the metric class.
+
+    Ids of removed series are reused, so the handle also keeps the
+    generation of its id. Once the series is removed the handle is like
+    the child of a removed label set: it reads 0 and its writes are lost,
+    they never reach the series that took over the id.
+    '''
+    __slots__ = ('_family', '_series', '_generation')
+
+    def __init__(self, family, series, generation):
+        self._family = family
+        self._series = series
+        self._generation = generation
+
+    @property
+    def _lock(self):
+        return self._family._lock
+
+    @property
+    def _value(self):
+        family = self._family
+        if family._generations[self._series] != self._generation:
+            return 0.0
+        return family._values[self._series]
+
+    @_value.setter
+    def _value(self, value):
+        family = self._family
+        if family._generations[self._series] == self._generation:
+            family._values[self._series] = value
+
+
+_COLUMNAR_CHILDREN = {}
+
+
+def _columnar_child(cls):
+    '''Returns the handle class for series of a columnar family of cls.'''
+    if cls not in _COLUMNAR_CHILDREN:
+        methods = dict((name, f) for name, f in cls.__dict__.items()
+                       if callable(f) and not name.startswith('_') and name != 'set_function')
+        methods['__slots__'] = ()
+        _COLUMNAR_CHILDREN[cls] = type(str('_Columnar' + cls.__name__), (_ColumnarChild,), methods)
+    return _COLUMNAR_CHILDREN[cls]
+
+
+class _ColumnarLabelWrapper(object):
+    '''Handles labels for a counter or gauge that stores its series in columns.
+
+    Instead of an object per child, the values of all series are kept in
+    one array('d') indexed by series id, next to a list of label tuples
+    whose values are interned once per family. One lock guards the family.
+    labels() returns a small handle onto the arrays, see _ColumnarChild.
+
+    Supports the same ttl, max_children and overflow as _LabelWrapper.
+    '''
+    def __init__(self, wrappedClass, labelnames, ttl=None, max_children=None, overflow=True, **kwargs):
+        if wrappedClass._type not in ('counter', 'gauge'):
+            raise ValueError('Columnar storage is only available for counters and gauges')
+        if kwargs:
+            raise TypeError('Unexpected arguments for a columnar metric: ' + ', '.join(sorted(kwargs)))
+        self._wrappedClass = wrappedClass
+        self._type = wrappedClass._type
+        self._labelnames = labelnames
+        self._child = _columnar_child(wrappedClass)
+        self._lock = Lock()
+
+        # Series ids by label tuple, and per id its labels, value,
+        # rendered name{labels} prefix and the number of times it was
+        # removed. Removed ids are None and reused.
+        self._ids = {}
+        self._labels = []
+        self._values = array(str('d'))
+        self._prefixes = []
+        self._generations = []
+        self._free = []
+        self._strings = {}
+
+        self._ttl = ttl
+        self._seen = set()
+        self._missed = {}
+        self._max_children = max_children
+        self._overflow = overflow
+        self._own_limit = max_children is not None
+        self._rejected = 0
+        self._discarded = None
+
+        for l in labelnames:
+            if l.startswith('__'):
+                raise ValueError('Invalid label metric name: ' + l)
+
+    def labels(self, *labelvalues):
+        '''Return the child for the given labelset, see _LabelWrapper.labels().'''
+        try:
+            series = self._ids[labelvalues]
+            self._seen.add(labelvalues)
+            return self._child(self, series, self._generations[series])
+        except (KeyError, TypeError):
+            pass
+        return self._add(_label_tuple(self._labelnames, labelvalues))
+
+    def set_many(self, values, labelvalues=None):
+        '''Set the value of many series at once, see _LabelWrapper.set_many().'''
+        if labelvalues is None:
+            items = values.items()
+        else:
+            if len(values) != len(labelvalues):
+                raise ValueError('Incorrect value count')
+            items = zip(labelvalues, values)
+
+        ids = self._ids
+        seen = self._seen
+        updates = []
+        for key, value in items:
+            if type(key) is not tuple:
+                key = (key,)
+            series = ids.get(key)
+            if series is None:
+                child = self.labels(*key)
+                if child is self._discarded:
+                    continue
+                series = child._series
+            else:
+                seen.add(key)
+            updates.append((series, key, float(value)))
+
+        column = self._values
+        rows = self._labels
+        with self._lock:
+            for series, key, value in updates:
+                # The series may have been removed since it was looked up.
+                if rows[series] == key:
+                    column[series] = value
+
+    def _add(self, labelvalues, limited=True):
+        with self._lock:
+            series = self._ids.get(labelvalues)
+            full = limited and self._max_children is not None and len(self._ids) >= self._max_children
+            if series is None and not full:
+                labelvalues = tuple([self._strings.setdefault(v, v) for v in labelvalues])
+                if self._free:
+                    series = self._free.pop()
+                    self._labels[series] = labelvalues
+                    self._values[series] = 0.0
+                else:
+                    series = len(self._labels)
+                    self._labels.append(labelvalues)
+                    self._values.append(0.0)
+                    self._prefixes.append(None)
+                    self._generations.append(0)
+                self._ids[labelvalues] = series
+            generation = self._generations[series] if series is not None else None
+        if series is None:
+            return self._reject()
+        self._seen.add(labelvalues)
+        return self._child(self, series, generation)
+
+    def _reject(self):
+        self._rejected += 1
+        if self._overflow:
+            return self._add((OVERFLOW_LABEL_VALUE,) * len(self._labelnames), limited=False)
+        if self._discarded is None:
+            self._discarded = self._wrappedClass()
+        return self._discarded
+
+    def _remove_series(self, labelvalues):
+        series = self._ids.pop(labelvalues)
+        self._labels[series] = None
+        self._prefixes[series] = None
+        self._generations[series] += 1
+        self._free.append(series)
+
+    def remove(self, *labelvalues):
+        '''Remove the given labelset from the metric.'''
+        if len(labelvalues) != len(self._labelnames):
+            raise ValueError('Incorrect label count')
+        labelvalues = tuple([unicode(l) for l in labelvalues])
+        with self._lock:
+            self._remove_series(labelvalues)
+        self._missed.pop(labelvalues, None)
+
+    def _limit(self, max_children, overflow):
+        if not self._own_limit:
+            self._max_children = max_children
+            self._overflow = overflow
+
+    def _expire(self, ttl=None):
+        ttl = self._ttl or ttl
+        seen, self._seen = self._seen, set()
+        if not ttl:
+            return 0
+
+        missed = self._missed
+        evicted = 0
+        with self._lock:
+            for labelvalues in list(self._ids):
+                if labelvalues in seen:
+                    missed.pop(labelvalues, None)
+                    continue
+                missed[labelvalues] = missed.get(labelvalues, 0) + 1
+                if missed[labelvalues] >= ttl:
+                    self._remove_series(labelvalues)
+                    del missed[labelvalues]
+                    evicted += 1
+            if evicted:
+                self._strings = dict((v, v) for labelvalues in self._ids for v in labelvalues)
+        return evicted
+
+    def _rows(self):
+        '''Returns a consistent copy of the label tuples, values and prefixes.'''
+        with self._lock:
+            return list(self._labels), self._values[:], list(self._prefixes)
+
+    def _samples(self):
+        labels, values, _ = self._rows()
+        for series, labelvalues in enumerate(labels):
+            if labelvalues is not None:
+                yield ('', dict(zip(self._labelnames, labelvalues)), values[series])
+
+    def _select(self, labels):
+        '''Yields the samples of the series that have all the given labels.'''
+        if any(l not in self._labelnames for l in labels):
+            return
+        series_labels = dict((l, unicode(v)) for l, v in labels.items())
+        if len(series_labels) == len(self._labelnames):
+            key = tuple(series_labels[l] for l in self._labelnames)
+            with self._lock:
+                series = self._ids.get(key)
+                value = self._values[series] if series is not None else None
+            if series is not None:
+                yield ('', dict(zip(self._labelnames, key)), value)
+            return
+
+        positions = [(list(self._labelnames).index(l), v) for l, v in series_labels.items()]
+        rows, values, _ = self._rows()
+        for series, labelvalues in enumerate(rows):
+            if labelvalues is not None and all(labelvalues[i] == v for i, v in positions):
+                yield ('', dict(zip(self._labelnames, labelvalues)), values[series])
+
+    def _render_text(self, full_name, output, snapshot=None):
+        labels, values, prefixes = self._rows()
+        for series, labelvalues in enumerate(labels):
+            if labelvalues is None:
+                continue
+            if snapshot is not None:
+                snapshot.append((full_name, dict(zip(self._labelnames, labelvalues)), values[series]))
+            prefix = prefixes[series]
+            if prefix is None:
+                prefix = (full_name + _render_labels(dict(zip(self._labelnames, labelvalues))) + ' ').encode('utf-8')
+                with self._lock:
+                    if self._labels[series] is labelvalues:
+                        self._prefixes[series] = prefix
+            output.append(prefix + _floatToGoString(values[series]).encode('utf-8') + b'\n')
+
+
+def _select_samples(metric, labels):
+    '''Returns the samples of an unlabeled metric that have all the given labels.'''
+    return [sample for sample in metric._samples()
+            if all(sample[1].get(l) == v for l, v in labels.items())]
 
 
 def _MetricWrapper(cls):
     '''Provides common functionality for metrics.'''
-    def init(name, documentation, labelnames=(), namespace='', subsystem='', registry=REGISTRY, **kwargs):
+    def init(name, documentation, labelnames=(), namespace='', subsystem='', registry=REGISTRY,
+             ttl=None, max_children=None, overflow=True, columnar=None, **kwargs):
         if labelnames:
             for l in labelnames:
                 if not _METRIC_LABEL_NAME_RE.match(l):
@@ -153,7 +943,16 @@ def _MetricWrapper(cls):
                     raise ValueError('Reserved label metric name: ' + l)
                 if l in cls._reserved_labelnames:
                     raise ValueError('Reserved label metric name: ' + l)
-            collector = _LabelWrapper(cls, labelnames, **kwargs)
+            if columnar is None:
+                # The scope only applies to the types that support it.
+                columnar = (registry is not None and registry._columnar_scope()
+                            and cls._type in ('counter', 'gauge'))
+            if columnar:
+                collector = _ColumnarLabelWrapper(cls, labelnames, ttl=ttl, max_children=max_children,
+                                                  overflow=overflow, **kwargs)
+            else:
+                collector = _LabelWrapper(cls, labelnames, ttl=ttl, max_children=max_children,
+                                          overflow=overflow, **kwargs)
         else:
             collector = cls(**kwargs)
 
@@ -167,11 +966,19 @@ def _MetricWrapper(cls):
         if not _METRIC_NAME_RE.match(full_name):
             raise ValueError('Invalid metric name: ' + full_name)
 
+        header = _render_header(full_name, documentation, cls._type)
+        if labelnames:
+            render = collector._render_text
+            select = collector._select
+        else:
+            def render(name, output, snapshot=None):
+                _render_child(collector, name, (), (), output, snapshot)
+
+            def select(labels):
+                return _select_samples(collector, labels)
+
         def collect():
-            metric = Metric(full_name, documentation, cls._type)
-            for suffix, labels, value in collector._samples():
-                metric.add_sample(full_name + suffix, labels, value)
-            return [metric]
+            return [_CollectorMetric(full_name, documentation, cls._type, collector._samples, render, header, select)]
         collector.collect = collect
 
         if registry:
@@ -185,10 +992,12 @@ def _MetricWrapper(cls):
 class Counter(object):
     _type = 'counter'
     _reserved_labelnames = []
+    __slots__ = ('_value', '_lock', '_text_cache', 'collect')
 
     def __init__(self):
         self._value = 0.0
-        self._lock = Lock()
+        self._lock = _value_lock()
+        self._text_cache = None
 
     def set(self, value):
         '''Set counter to the given value.'''
@@ -239,10 +1048,13 @@ class Counter(object):
 class Gauge(object):
     _type = 'gauge'
     _reserved_labelnames = []
+    __slots__ = ('_value', '_function', '_lock', '_text_cache', 'collect')
 
     def __init__(self):
         self._value = 0.0
-        self._lock = Lock()
+        self._function = None
+        self._lock = _value_lock()
+        self._text_cache = None
 
     def inc(self, amount=1):
         '''Increment gauge by the given amount.'''
@@ -297,30 +1109,187 @@ class Gauge(object):
         multiple threads.
         All other methods of the Gauge become NOOPs.
         '''
-        def samples(self):
-            return (('', {}, float(f())), )
-        self._samples = types.MethodType(samples, self)
+        self._function = f
 
     def _samples(self):
+        if self._function is not None:
+            return (('', {}, float(self._function())), )
         with self._lock:
             return (('', {}, self._value), )
 
 
+class _CKMSStream(object):
+    '''Biased quantile estimator for a set of targeted quantiles.
+
+    Cormode, Korn, Muthukrishnan, Srivastava: "Effective Computation of
+    Biased Quantiles over Data Streams". Only as many samples are kept as
+    the error bounds of the targets require.
+    '''
+
+    def __init__(self, targets):
+        self._targets = targets
+        self.reset()
+
+    def reset(self):
+        self._n = 0.0
+        # [value, width, delta]
+        self._samples = []
+
+    def merge(self, values):
+        '''Merges a sorted list of values into the stream.'''
+        samples = self._samples
+        self._n += len(values)
+        f = self._invariant()
+        merged = []
+        i = 0
+        r = 0.0
+        for value in values:
+            while i < len(samples) and samples[i][0] <= value:
+                merged.append(samples[i])
+                r += samples[i][1]
+                i += 1
+            delta = 0.0
+            if i < len(samples):
+                delta = max(math.floor(f(r)) - 1, 0.0)
+            merged.append([value, 1.0, delta])
+            r += 1
+        merged.extend(samples[i:])
+        self._samples = merged
+        self._compress()
+
+    def query(self, q):
+        if not self._samples:
+            return float('nan')
+
+        t = math.ceil(q * self._n)
+        t += math.ceil(self._invariant()(t) / 2)
+        previous = self._samples[0]
+        r = 0.0
+        for sample in self._samples[1:]:
+            r += previous[1]
+            if r + sample[1] + sample[2] > t:
+                return previous[0]
+            previous = sample
+        return previous[0]
+
+    def _invariant(self):
+        '''Returns f(r), the allowed rank error at rank r.'''
+        n = self._n
+        bounds = [(q * n, 2 * e / q, 2 * e / (1 - q)) for q, e in self._targets]
+
+        def f(r):
+            m = float('inf')
+            for qn, below, above in bounds:
+                if qn <= r:
+                    e = below * r
+                else:
+                    e = above * (n - r)
+                if e < m:
+                    m = e
+            return m
+        return f
+
+    def _compress(self):
+        samples = self._samples
+        if len(samples) < 2:
+            return
+        f = self._invariant()
+        x = samples[-1]
+        kept = [x]
+        r = self._n - 1 - x[1]
+        for i in range(len(samples) - 2, -1, -1):
+            c = samples[i]
+            if c[1] + x[1] + x[2] <= f(r):
+                x[1] += c[1]
+            else:
+                x = c
+                kept.append(c)
+            r -= c[1]
+        kept.reverse()
+        self._samples = kept
+
+
+class _WindowedQuantiles(object):
+    '''Quantiles over the last max_age seconds.
+
+    Observations are appended to a buffer, which is sorted once and merged
+    into age_buckets streams when it is full or queried. The streams were
+    started one after the other; the oldest answers queries, and is reset
+    to become the newest every max_age / age_buckets seconds.
+    '''
+    _BUFFER_SIZE = 500
+
+    def __init__(self, targets, max_age, age_buckets):
+        self._streams = [_CKMSStream(targets) for _ in range(age_buckets)]
+        self._head = 0
+        self._buffer = []
+        self._rotate_every = float(max_age) / age_buckets
+        self._next_rotation = time.time() + self._rotate_every
+
+    def _flush(self):
+        if self._buffer:
+            values = sorted(self._buffer)
+            self._buffer = []
+            for stream in self._streams:
+                stream.merge(values)
+
+    def _rotate(self, now):
+        if now < self._next_rotation:
+            if now < self._next_rotation - self._rotate_every:
+                # The clock was set back, start the current interval again.
+                self._next_rotation = now + self._rotate_every
+            return
+        self._flush()
+        # Worked out at once, the clock may have jumped years ahead.
+        rotations = int((now - self._next_rotation) // self._rotate_every) + 1
+        for _ in range(min(rotations, len(self._streams))):
+            self._streams[self._head].reset()
+            self._head = (self._head + 1) % len(self._streams)
+        self._next_rotation += rotations * self._rotate_every
+
+    def insert(self, value):
+        self._rotate(time.time())
+        self._buffer.append(value)
+        if len(self._buffer) >= self._BUFFER_SIZE:
+            self._flush()
+
+    def query(self, q):
+        self._rotate(time.time())
+        self._flush()
+        return self._streams[self._head].query(q)
+
+
 @_MetricWrapper
 class Summary(object):
     _type = 'summary'
     _reserved_labelnames = ['quantile']
+    __slots__ = ('_count', '_sum', '_quantiles', '_targets', '_lock', '_text_cache', 'collect')
 
-    def __init__(self):
+    def __init__(self, quantiles=(), max_age=600, age_buckets=5):
+        '''quantiles are (quantile, allowed error) pairs, e.g. ((0.5, 0.05), (0.99, 0.001)).
+
+        They are estimated over the last max_age seconds. Without quantiles
+        only _count and _sum are tracked.'''
         self._count = 0.0
         self._sum = 0.0
-        self._lock = Lock()
+        self._lock = _value_lock()
+        self._text_cache = None
+
+        self._targets = tuple((float(q), float(e)) for q, e in quantiles)
+        for q, e in self._targets:
+            if not 0 < q < 1 or not 0 < e < 1:
+                raise ValueError('Quantile and error must be in (0, 1)')
+        self._quantiles = None
+        if self._targets:
+            self._quantiles = _WindowedQuantiles(self._targets, max_age, age_buckets)
 
     def observe(self, amount):
         '''Observe the given amount.'''
         with self._lock:
             self._count += 1
             self._sum += amount
+            if self._quantiles is not None:
+                self._quantiles.insert(amount)
 
     def time(self):
         '''Time a block of code or function, and observe the duration in seconds.
@@ -350,9 +1319,11 @@ class Summary(object):
 
     def _samples(self):
         with self._lock:
-            return (
-                ('_count', {}, self._count),
-                ('_sum', {}, self._sum))
+            samples = [('', {'quantile': _floatToGoString(q)}, self._quantiles.query(q))
+                       for q, _ in self._targets]
+            samples.append(('_count', {}, self._count))
+            samples.append(('_sum', {}, self._sum))
+            return tuple(samples)
 
 
 def _floatToGoString(d):
@@ -360,18 +1331,30 @@ def _floatToGoString(d):
         return '+Inf'
     elif d == _MINUS_INF:
         return '-Inf'
+    elif d != d:
+        # The spelling of both formats, repr() would give nan.
+        return 'NaN'
     else:
         return repr(float(d))
 
 
+def _bucket_index(bounds, amount):
+    # NaN compares false with every bound, bisect would put it first.
+    if amount != amount:
+        return len(bounds) - 1
+    return bisect_left(bounds, amount)
+
+
 @_MetricWrapper
 class Histogram(object):
     _type = 'histogram'
     _reserved_labelnames = ['histogram']
+    __slots__ = ('_sum', '_upper_bounds', '_buckets', '_lock', '_text_cache', 'collect')
 
     def __init__(self, buckets=(.005, .01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5, 5.0, 7.5, 10.0, _INF)):
         self._sum = 0.0
-        self._lock = Lock()
+        self._lock = _value_lock()
+        self._text_cache = None
         buckets = [float(b) for b in buckets]
         if buckets != sorted(buckets):
             # This is probably an error on the part of the user,
@@ -386,12 +1369,23 @@ class Histogram(object):
 
     def observe(self, amount):
         '''Observe the given amount.'''
+        # First bucket with amount <= bound, the last one is +Inf.
+        i = _bucket_index(self._upper_bounds, amount)
         with self._lock:
             self._sum += amount
-            for i, bound in enumerate(self._upper_bounds):
-                if amount <= bound:
-                    self._buckets[i] += 1
-                    break
+            self._buckets[i] += 1
+
+    def observe_many(self, amounts):
+        '''Observe every amount of the iterable, taking the lock once.'''
+        amounts = list(amounts)
+        bounds = self._upper_bounds
+        indexes = [_bucket_index(bounds, amount) for amount in amounts]
+        total = sum(amounts)
+        with self._lock:
+            self._sum += total
+            buckets = self._buckets
+            for i in indexes:
+                buckets[i] += 1
 
     def time(self):
         '''Time a block of code or function, and observe the duration in seconds.
@@ -3,6 +3,7 @@
 from __future__ import unicode_literals
 
 import os
+import struct
 import threading
 
 from lib.prometheus_client import core
@@ -20,25 +21,255 @@ except ImportError:
 
 CONTENT_TYPE_LATEST = 'text/plain; version=0.0.4; charset=utf-8'
 '''Content type of the latest text format'''
+CONTENT_TYPE_OPENMETRICS = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+'''Content type of the OpenMetrics text format'''
+CONTENT_TYPE_PROTOBUF = ('application/vnd.google.protobuf; '
+                         'proto=io.prometheus.client.MetricFamily; encoding=delimited')
+'''Content type of the delimited protobuf format'''
 
 
-def generate_latest(registry=core.REGISTRY):
-    '''Returns the metrics from the registry in latest text format as a string.'''
-    output = []
+def generate_latest_chunks(registry=core.REGISTRY):
+    '''Yields the metrics from the registry in latest text format.
+
+    Each chunk holds one metric family, encoded, so only one family is
+    rendered in memory at a time.'''
     for metric in registry.collect():
-        output.append('# HELP {0} {1}'.format(
-            metric._name, metric._documentation.replace('\\', r'\\').replace('\n', r'\n')))
+        render = getattr(metric, '_render_text', None)
+        if render is not None:
+            # Our own metrics keep their rendered lines between scrapes.
+            yield render()
+            continue
+
+        output = []
+        output.append('# HELP {0} {1}'.format(metric._name, core._escape_help(metric._documentation)))
         output.append('\n# TYPE {0} {1}\n'.format(metric._name, metric._type))
         for name, labels, value in metric._samples:
+            output.append('{0}{1} {2}\n'.format(name, core._render_labels(labels), core._floatToGoString(value)))
+        yield ''.join(output).encode('utf-8')
+
+
+def generate_latest(registry=core.REGISTRY):
+    '''Returns the metrics from the registry in latest text format as a string.'''
+    return b''.join(generate_latest_chunks(registry))
+
+
+def _escape_openmetrics(s):
+    return s.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+_OPENMETRICS_TYPES = {'untyped': 'unknown'}
+
+
+def generate_openmetrics_chunks(registry=core.REGISTRY):
+    '''Yields the metrics from the registry in OpenMetrics text format.
+
+    Like generate_latest_chunks(), one encoded chunk per metric family,
+    followed by the closing # EOF line.'''
+    for metric in registry.collect():
+        name = metric._name
+        is_counter = metric._type == 'counter'
+        if is_counter and name.endswith('_total'):
+            name = name[:-6]
+
+        output = []
+        output.append('# TYPE {0} {1}\n'.format(name, _OPENMETRICS_TYPES.get(metric._type, metric._type)))
+        output.append('# HELP {0} {1}\n'.format(name, _escape_openmetrics(metric._documentation)))
+        for sample_name, labels, value in metric._samples:
+            if is_counter and not sample_name.endswith('_total'):
+                sample_name += '_total'
             if labels:
                 labelstr = '{{{0}}}'.format(','.join(
-                    ['{0}="{1}"'.format(
-                     k, v.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"'))
+                    ['{0}="{1}"'.format(k, _escape_openmetrics(v))
                      for k, v in sorted(labels.items())]))
             else:
                 labelstr = ''
-            output.append('{0}{1} {2}\n'.format(name, labelstr, core._floatToGoString(value)))
-    return ''.join(output).encode('utf-8')
+            output.append('{0}{1} {2}\n'.format(sample_name, labelstr, core._floatToGoString(value)))
+        yield ''.join(output).encode('utf-8')
+    yield b'# EOF\n'
+
+
+def generate_openmetrics(registry=core.REGISTRY):
+    '''Returns the metrics from the registry in OpenMetrics text format.'''
+    return b''.join(generate_openmetrics_chunks(registry))
+
+
+# Field numbers and enums of io.prometheus.client.MetricFamily (metrics.proto).
+_PROTOBUF_TYPES = {'counter': 0, 'gauge': 1, 'summary': 2, 'untyped': 3, 'histogram': 4}
+_PROTOBUF_VALUE_FIELDS = {'counter': 3, 'gauge': 2, 'untyped': 5}
+_SUMMARY_FIELD = 4
+_HISTOGRAM_FIELD = 7
+
+_double = struct.Struct(str('<d'))
+_BYTES = [struct.pack(str('B'), i) for i in range(256)]
+
+
+def _varint(value, output):
+    while value > 0x7f:
+        output.append(_BYTES[0x80 | (value & 0x7f)])
+        value >>= 7
+    output.append(_BYTES[value])
+
+
+def _tag(field, wire_type, output):
+    _varint((field << 3) | wire_type, output)
+
+
+def _pb_uint(field, value, output):
+    _tag(field, 0, output)
+    _varint(int(value), output)
+
+
+def _pb_double(field, value, output):
+    _tag(field, 1, output)
+    output.append(_double.pack(value))
+
+
+def _pb_bytes(field, data, output):
+    _tag(field, 2, output)
+    _varint(len(data), output)
+    output.append(data)
+
+
+def _pb_string(field, s, output):
+    _pb_bytes(field, s.encode('utf-8'), output)
+
+
+def _pb_message(field, parts, output):
+    _pb_bytes(field, b''.join(parts), output)
+
+
+def _protobuf_series(metric):
+    '''Groups samples into (labels, {suffix or le/quantile: value}) series.'''
+    series = []
+    index = {}
+    for name, labels, value in metric._samples:
+        suffix = name[len(metric._name):]
+        bound = None
+        if 'le' in labels and metric._type == 'histogram':
+            bound = labels['le']
+        elif 'quantile' in labels and metric._type == 'summary':
+            bound = labels['quantile']
+        if bound is not None:
+            labels = dict((k, v) for k, v in labels.items() if k not in ('le', 'quantile'))
+        key = tuple(sorted(labels.items()))
+        if key not in index:
+            index[key] = len(series)
+            series.append((labels, [], {}))
+        _, bounds, values = series[index[key]]
+        if bound is not None:
+            bounds.append((float(bound), value))
+        else:
+            values[suffix] = value
+    return series
+
+
+def _protobuf_family(metric):
+    family = []
+    _pb_string(1, metric._name, family)
+    _pb_string(2, metric._documentation, family)
+    _pb_uint(3, _PROTOBUF_TYPES[metric._type], family)
+
+    for labels, bounds, values in _protobuf_series(metric):
+        message = []
+        for k, v in sorted(labels.items()):
+            pair = []
+            _pb_string(1, k, pair)
+            _pb_string(2, v, pair)
+            _pb_message(1, pair, message)
+
+        body = []
+        if metric._type == 'histogram':
+            _pb_uint(1, values.get('_count', 0), body)
+            _pb_double(2, values.get('_sum', 0), body)
+            for bound, count in bounds:
+                # The +Inf bucket is implied by the sample count.
+                if bound == core._INF:
+                    continue
+                bucket = []
+                _pb_uint(1, count, bucket)
+                _pb_double(2, bound, bucket)
+                _pb_message(3, bucket, body)
+            _pb_message(_HISTOGRAM_FIELD, body, message)
+        elif metric._type == 'summary':
+            _pb_uint(1, values.get('_count', 0), body)
+            _pb_double(2, values.get('_sum', 0), body)
+            for quantile, value in bounds:
+                pair = []
+                _pb_double(1, quantile, pair)
+                _pb_double(2, value, pair)
+                _pb_message(3, pair, body)
+            _pb_message(_SUMMARY_FIELD, body, message)
+        else:
+            _pb_double(1, values.get('', 0), body)
+            _pb_message(_PROTOBUF_VALUE_FIELDS[metric._type], body, message)
+
+        _pb_message(4, message, family)
+    return b''.join(family)
+
+
+def generate_protobuf_chunks(registry=core.REGISTRY):
+    '''Yields the metrics from the registry as length delimited
+    io.prometheus.client.MetricFamily messages, one chunk per family.'''
+    for metric in registry.collect():
+        family = _protobuf_family(metric)
+        prefix = []
+        _varint(len(family), prefix)
+        yield b''.join(prefix) + family
+
+
+def generate_protobuf(registry=core.REGISTRY):
+    '''Returns the metrics from the registry in delimited protobuf format.'''
+    return b''.join(generate_protobuf_chunks(registry))
+
+
+# Preferred order when the client weights several formats the same.
+_ENCODERS = [
+    (CONTENT_TYPE_PROTOBUF, generate_protobuf_chunks),
+    (CONTENT_TYPE_OPENMETRICS, generate_openmetrics_chunks),
+    (CONTENT_TYPE_LATEST, generate_latest_chunks),
+]
+
+
+def _accepts(content_type, media_range, params):
+    if content_type == CONTENT_TYPE_PROTOBUF:
+        return (media_range == 'application/vnd.google.protobuf'
+                and params.get('proto') == 'io.prometheus.client.MetricFamily'
+                and params.get('encoding') == 'delimited')
+    if content_type == CONTENT_TYPE_OPENMETRICS:
+        return media_range == 'application/openmetrics-text'
+    return media_range in ('text/plain', 'text/*', '*/*')
+
+
+def choose_encoder(accept_header):
+    '''Returns (content_type, generate_chunks) for the given Accept header.
+
+    Falls back to the latest text format when nothing else fits.'''
+    weights = {}
+    for item in (accept_header or '').split(','):
+        parts = item.split(';')
+        media_range = parts[0].strip().lower()
+        if not media_range:
+            continue
+        params = {}
+        for param in parts[1:]:
+            key, _, value = param.strip().partition('=')
+            params[key.strip().lower()] = value.strip().strip('"')
+        try:
+            q = float(params.get('q', 1))
+        except ValueError:
+            q = 0.0
+        for content_type, _ in _ENCODERS:
+            if _accepts(content_type, media_range, params):
+                weights[content_type] = max(q, weights.get(content_type, 0))
+
+    best = None
+    for content_type, generate in _ENCODERS:
+        q = weights.get(content_type, 0)
+        if q > 0 and (best is None or q > best[0]):
+            best = (q, content_type, generate)
+    if best is None:
+        return CONTENT_TYPE_LATEST, generate_latest_chunks
+    return best[1], best[2]
 
 
 class MetricsHandler(BaseHTTPRequestHandler):
@@ -70,6 +301,7 @@ def write_to_textfile(path, registry):
     The path must end in .prom for the textfile collector to process it.'''
     tmppath = '%s.%s.%s' % (path, os.getpid(), threading.current_thread().ident)
     with open(tmppath, 'wb') as f:
-        f.write(generate_latest(registry))
+        for chunk in generate_latest_chunks(registry):
+            f.write(chunk)
     # rename(2) is atomic.
     os.rename(tmppath, path)
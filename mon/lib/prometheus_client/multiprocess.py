@@ -0,0 +1,216 @@
+#!/usr/bin/python
+
+from __future__ import unicode_literals
+
+import glob
+import json
+import mmap
+import os
+import struct
+import time
+from collections import OrderedDict
+
+from lib.prometheus_client import core
+
+_INITIAL_MMAP_SIZE = 1 << 16
+_USED = struct.Struct(str('<i4x'))
+_KEY_LENGTH = struct.Struct(str('<i'))
+_VALUE = struct.Struct(str('<dd'))
+
+AGGREGATIONS = ('sum', 'max', 'latest', 'pid')
+# Key of the refusals of the writer's series limits, which is no sample.
+_REJECTED_KEY = '__rejected__'
+
+
+def _padded_length(length):
+    # Keeps the value after the key aligned to 8 bytes.
+    return length + 8 - (length + _KEY_LENGTH.size) % 8
+
+
+def _read_all(data, used):
+    '''Yields key, value, timestamp and offset of the value of every entry.'''
+    pos = _USED.size
+    while pos < used:
+        length = _KEY_LENGTH.unpack_from(data, pos)[0]
+        pos += _KEY_LENGTH.size
+        key = data[pos:pos + length].decode('utf-8')
+        pos += _padded_length(length)
+        value, timestamp = _VALUE.unpack_from(data, pos)
+        yield key, value, timestamp, pos
+        pos += _VALUE.size
+
+
+def read_file(filename):
+    '''Returns (key, value, timestamp) of the entries of a file written by MmapedDict.'''
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if len(data) < _USED.size:
+        return []
+    used = _USED.unpack_from(data, 0)[0]
+    return [(key, value, timestamp) for key, value, timestamp, _ in _read_all(data, used)]
+
+
+class MmapedDict(object):
+    '''A dict of values with timestamps, kept in a memory mapped file.
+
+    The file starts with the number of bytes in use. Each entry is the
+    length of the key, the utf-8 key padded to 8 bytes, then the value and
+    timestamp as doubles. Entries are only appended and the used count is
+    updated after an entry is complete, so readers never see half a key;
+    values are overwritten in place. One writer per file, not thread safe.
+    '''
+    def __init__(self, filename):
+        self._f = open(filename, 'a+b')
+        if os.fstat(self._f.fileno()).st_size == 0:
+            self._f.truncate(_INITIAL_MMAP_SIZE)
+        self._capacity = os.fstat(self._f.fileno()).st_size
+        self._m = mmap.mmap(self._f.fileno(), self._capacity)
+
+        self._positions = {}
+        self._used = _USED.unpack_from(self._m, 0)[0]
+        if self._used == 0:
+            self._used = _USED.size
+            _USED.pack_into(self._m, 0, self._used)
+        for key, _, _, pos in _read_all(self._m, self._used):
+            self._positions[key] = pos
+
+    def _init_value(self, key):
+        encoded = key.encode('utf-8')
+        padded = encoded.ljust(_padded_length(len(encoded)), b' ')
+        entry = _KEY_LENGTH.pack(len(encoded)) + padded + _VALUE.pack(0.0, 0.0)
+        while self._used + len(entry) > self._capacity:
+            self._capacity *= 2
+            self._f.truncate(self._capacity)
+            self._m.close()
+            self._m = mmap.mmap(self._f.fileno(), self._capacity)
+
+        self._m[self._used:self._used + len(entry)] = entry
+        self._positions[key] = self._used + len(entry) - _VALUE.size
+        self._used += len(entry)
+        _USED.pack_into(self._m, 0, self._used)
+
+    def write_value(self, key, value, timestamp):
+        if key not in self._positions:
+            self._init_value(key)
+        _VALUE.pack_into(self._m, self._positions[key], value, timestamp)
+
+    def close(self):
+        self._m.close()
+        self._f.close()
+
+
+class MultiProcessWriter(object):
+    '''Copies metrics of this process into its file in directory.
+
+    aggregation says how the server merges a family over the processes:
+    one of AGGREGATIONS for all of them, or a dict of family name to
+    aggregation, where unlisted families use 'latest'.
+    '''
+    def __init__(self, directory, aggregation='latest'):
+        aggregations = aggregation.values() if isinstance(aggregation, dict) else [aggregation]
+        for a in aggregations:
+            if a not in AGGREGATIONS:
+                raise ValueError('Invalid aggregation: {0}'.format(a))
+        self._aggregation = aggregation
+        self._dict = MmapedDict(os.path.join(directory, '{0}.db'.format(os.getpid())))
+        self._written = set()
+
+    def _aggregation_of(self, name):
+        if isinstance(self._aggregation, dict):
+            return self._aggregation.get(name, 'latest')
+        return self._aggregation
+
+    def flush(self, registry=core.REGISTRY, owner=None):
+        '''Writes the current samples of owner's metrics, or of all without owner.
+
+        With owner, the refusals of its series limits are written as well.
+        '''
+        now = time.time()
+        if owner is not None:
+            self._dict.write_value(_REJECTED_KEY, registry.rejected(owner), now)
+        written = set()
+        owners = None if owner is None else [owner]
+        for metric in registry.collect(owners, unowned=owner is None):
+            family = [metric._name, metric._type, metric._documentation, self._aggregation_of(metric._name)]
+            for name, labels, value in metric._samples:
+                key = json.dumps(family + [name, labels], sort_keys=True, separators=(',', ':'))
+                self._dict.write_value(key, value, now)
+                written.add(key)
+
+        # A timestamp of 0 marks series that are gone, readers skip them.
+        for key in self._written - written:
+            self._dict.write_value(key, 0.0, 0.0)
+        self._written = written
+
+
+def _latest(values):
+    return max(values, key=lambda v: v[2])[1]
+
+
+_AGGREGATE = {
+    'sum': lambda values: sum(v[1] for v in values),
+    'max': lambda values: max(v[1] for v in values),
+    'latest': _latest,
+}
+
+
+class MultiProcessCollector(object):
+    '''Collector for the metrics written into directory by other processes.
+
+    The files are read on every collect(), so a process that stopped
+    writing costs nothing but the age of its values.
+    '''
+    def __init__(self, directory, registry=core.REGISTRY):
+        self._directory = directory
+        if registry:
+            registry.register(self)
+
+    def collect(self):
+        families = OrderedDict()
+        for filename in sorted(glob.glob(os.path.join(self._directory, '*.db'))):
+            pid = os.path.basename(filename)[:-len('.db')]
+            try:
+                entries = read_file(filename)
+            except IOError:
+                # The process just went away.
+                continue
+            for key, value, timestamp in entries:
+                if not timestamp or key == _REJECTED_KEY:
+                    continue
+                name, typ, documentation, aggregation, sample_name, labels = json.loads(key)
+                if name not in families:
+                    families[name] = (typ, documentation, aggregation, OrderedDict())
+                series = (sample_name, tuple(sorted(labels.items())))
+                families[name][3].setdefault(series, []).append((pid, value, timestamp))
+
+        metrics = []
+        for name, (typ, documentation, aggregation, samples) in families.items():
+            metric = core.Metric(name, documentation, typ)
+            for (sample_name, labels), values in samples.items():
+                if aggregation == 'pid':
+                    for pid, value, _ in values:
+                        metric.add_sample(sample_name, dict(labels, pid=pid), value)
+                else:
+                    metric.add_sample(sample_name, dict(labels), _AGGREGATE[aggregation](values))
+            metrics.append(metric)
+        return metrics
+
+    @property
+    def _rejected(self):
+        '''Refusals of the series limits of the writing processes, see CollectorRegistry.rejected().'''
+        total = 0
+        for filename in glob.glob(os.path.join(self._directory, '*.db')):
+            try:
+                entries = read_file(filename)
+            except IOError:
+                continue
+            total += sum(int(value) for key, value, timestamp in entries if key == _REJECTED_KEY and timestamp)
+        return total
+
+
+def mark_process_dead(directory, pid):
+    '''Drops the values written by a process that exited.'''
+    try:
+        os.remove(os.path.join(directory, '{0}.db'.format(pid)))
+    except OSError:
+        pass
@@ -5,6 +5,7 @@ from __future__ import unicode_literals
 import os
 
 from lib.prometheus_client import core
+from lib.procfs import ProcFiles
 
 try:
   import resource
@@ -24,6 +25,8 @@ class ProcessCollector(object):
             self._prefix = namespace + '_process_'
         else:
             self._prefix = 'process_'
+        # Kept open between scrapes, see ProcFile.
+        self._files = ProcFiles()
         self._ticks = 100.0
         try:
             self._ticks = os.sysconf('SC_CLK_TCK')
@@ -56,10 +59,14 @@ class ProcessCollector(object):
           raise
           return []
 
+        stat_path = os.path.join(pid, 'stat')
+        limits_path = os.path.join(pid, 'limits')
+        # The files of another pid are of no use anymore.
+        self._files.retain([stat_path, limits_path])
+
         result = []
         try:
-            with open(os.path.join(pid, 'stat')) as stat:
-                parts = (stat.read().split(')')[-1].split())
+            parts = self._files.read(stat_path).split(')')[-1].split()
             vmem = core.Metric(self._prefix + 'virtual_memory_bytes', 'Virtual memory size in bytes', 'gauge')
             vmem.add_sample(self._prefix + 'virtual_memory_bytes', {}, float(parts[20]))
             rss = core.Metric(self._prefix + 'resident_memory_bytes', 'Resident memory size in bytes', 'gauge')
@@ -79,11 +86,10 @@ class ProcessCollector(object):
 
         try:
             max_fds = core.Metric(self._prefix + 'max_fds', 'Maximum number of open file descriptors.', 'gauge')
-            with open(os.path.join(pid, 'limits')) as limits:
-                for line in limits:
-                    if line.startswith('Max open file'):
-                        max_fds.add_sample(self._prefix + 'max_fds', {}, float(line.split()[3]))
-                        break
+            for line in self._files.read(limits_path).splitlines():
+                if line.startswith('Max open file'):
+                    max_fds.add_sample(self._prefix + 'max_fds', {}, float(line.split()[3]))
+                    break
             open_fds = core.Metric(self._prefix + 'open_fds', 'Number of open file descriptors.', 'gauge')
             open_fds.add_sample(self._prefix + 'open_fds', {}, len(os.listdir(os.path.join(pid, 'fd'))))
             result.extend([open_fds, max_fds])
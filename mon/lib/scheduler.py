@@ -0,0 +1,113 @@
+import heapq
+import itertools
+import logging
+import Queue
+import random
+import threading
+import time
+
+
+class Job(object):
+
+    def __init__(self, name, func, interval, queue=None):
+        self.name = name
+        self.func = func
+        self.interval = float(interval)
+        self.next_run = 0
+        self.running = False
+        # Own queue and worker of a blocking job, None for the shared ones.
+        self.queue = queue
+
+
+class Scheduler(object):
+    """Runs jobs in the background, each one on its own interval.
+
+    The first run of every job is delayed by a random fraction of its
+    interval so jobs added together do not fire together. After that a job
+    keeps its phase: runs that were missed are skipped, not queued up, and
+    a job is never started again while its previous run is still going.
+
+    Jobs added with blocking=True, like the ones waiting on a serial port
+    or the network, get a worker of their own, so a job stuck in I/O only
+    delays its own next runs, never the jobs on the shared workers.
+    """
+
+    def __init__(self, workers=2):
+        self.workers = workers
+
+        self._cond = threading.Condition(threading.Lock())
+        self._heap = []
+        self._order = itertools.count()
+        self._queue = Queue.Queue()
+        self._blocking = []
+        self._started = False
+
+    def add(self, name, func, interval, blocking=False):
+        # The dispatcher divides by the interval, in a thread of its own.
+        if not float(interval) > 0:
+            raise ValueError("Interval of {} must be positive, not {}".format(name, interval))
+        job = Job(name, func, interval, Queue.Queue() if blocking else None)
+        job.next_run = time.time() + random.uniform(0, job.interval)
+
+        with self._cond:
+            heapq.heappush(self._heap, (job.next_run, next(self._order), job))
+            if blocking:
+                self._blocking.append(job)
+                if self._started:
+                    self._spawn(self._work, job.queue)
+            self._cond.notify()
+        return job
+
+    def start(self):
+        with self._cond:
+            if self._started:
+                return
+            self._started = True
+
+            for _ in xrange(max(1, self.workers)):
+                self._spawn(self._work, self._queue)
+            for job in self._blocking:
+                self._spawn(self._work, job.queue)
+            self._spawn(self._dispatch)
+
+    @staticmethod
+    def _spawn(target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.time()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    self._cond.wait(self._heap[0][0] - now if self._heap else None)
+
+                next_run, _, job = heapq.heappop(self._heap)
+
+                job.next_run = next_run + job.interval
+                if job.next_run <= now:
+                    missed = int((now - job.next_run) // job.interval) + 1
+                    job.next_run += missed * job.interval
+                heapq.heappush(self._heap, (job.next_run, next(self._order), job))
+
+                if job.running:
+                    continue
+                job.running = True
+
+            (job.queue or self._queue).put(job)
+
+    def _work(self, queue):
+        while True:
+            job = queue.get()
+            try:
+                job.func()
+            except Exception as e:
+                logging.error("Exception {} in {} while collecting".format(str(e), job.name))
+            finally:
+                job.running = False
+
+
+scheduler = Scheduler()
@@ -0,0 +1,129 @@
+import glob
+import logging
+import os
+import subprocess
+import sys
+import time
+from functools import partial
+
+from lib.collect import count_rejected, run_collect
+from lib.prometheus_client import REGISTRY
+from lib.prometheus_client.multiprocess import MultiProcessCollector, MultiProcessWriter, mark_process_dead
+from lib.scheduler import scheduler
+
+from plugins.base_plugin import BasePlugin
+
+MAIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+
+
+def worker_directory(settings, name):
+    return os.path.join(settings.get("multiprocess_dir", "/tmp/mon-workers"), name)
+
+
+class Worker(object):
+    """A plugin running in its own process.
+
+    The process writes the plugin's metrics into a file of its own, which
+    the server reads on scrape. A worker that exits is started again,
+    waiting twice as long after every exit that came within a minute.
+    """
+
+    def __init__(self, name, config_path, directory):
+        self.name = name
+        self.config_path = config_path
+        self.directory = directory
+
+        self.process = None
+        self.started = 0
+        self.backoff = 1
+        self.restart_at = 0
+
+    def start(self):
+        # Without close_fds the worker would inherit the listening socket and
+        # keep the port bound if it outlived the server.
+        self.process = subprocess.Popen([sys.executable, MAIN, "--config", self.config_path, "--worker", self.name],
+                                        close_fds=True)
+        self.started = time.time()
+        logging.info("Worker {} started with pid {}".format(self.name, self.process.pid))
+
+    def check(self):
+        if self.process is not None and self.process.poll() is None:
+            return
+
+        now = time.time()
+        if self.process is not None:
+            logging.error("Worker {} exited with {}".format(self.name, self.process.returncode))
+            mark_process_dead(self.directory, self.process.pid)
+            self.process = None
+            self.backoff = self.backoff * 2 if now - self.started < 60 else 1
+            self.restart_at = now + min(self.backoff, 60)
+
+        if now >= self.restart_at:
+            self.start()
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+
+
+class Workers(object):
+    """Starts and watches the plugins configured with "process": true."""
+
+    def __init__(self):
+        self.workers = []
+
+    def add(self, name, config_path, settings):
+        directory = worker_directory(settings, name)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Files of an earlier run belong to processes that are gone.
+        for filename in glob.glob(os.path.join(directory, "*.db")):
+            os.remove(filename)
+
+        with REGISTRY.owner(name):
+            MultiProcessCollector(directory)
+        worker = Worker(name, config_path, directory)
+        self.workers.append(worker)
+        return worker
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        if self.workers:
+            scheduler.add("workers", self.check, 1)
+
+    def check(self):
+        for worker in self.workers:
+            worker.check()
+            # The workers write the refusals of their series limits, the
+            # server counts them like those of its own plugins.
+            count_rejected(worker.name)
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+
+workers = Workers()
+
+
+def run_worker(plugin_class, name, config, settings):
+    """Runs one plugin in this process and writes its metrics for the server."""
+    writer = MultiProcessWriter(worker_directory(settings, name), config.get("aggregation", "latest"))
+
+    with REGISTRY.owner(name):
+        plugin = plugin_class(config)
+    plugin.ttl = config.get("ttl", settings.get("ttl"))
+    plugin.start_update()
+
+    interval = config.get("interval", settings.get("collect_interval") or 5)
+    if type(plugin).collect != BasePlugin.collect:
+        scheduler.add(name, partial(run_collect, plugin), interval, blocking=config.get("blocking", False))
+    scheduler.start()
+
+    flush_interval = float(settings.get("worker_flush_interval", 1))
+    parent = os.getppid()
+    # Leave together with the server.
+    while os.getppid() == parent:
+        writer.flush(REGISTRY, name)
+        time.sleep(flush_interval)
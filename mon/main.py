@@ -4,16 +4,35 @@ import json
 import time
 import logging
 import argparse
+import atexit
 import signal
 import sys
+from functools import partial
 
 from plugins import plugins
 from plugins.base_plugin import BasePlugin
 
+from lib.collect import run_collect
 from lib.http import start_http_server
+from lib.prometheus_client import REGISTRY, write_to_textfile
+from lib.prometheus_client.bridge.graphite import GraphiteBridge
+from lib.scheduler import scheduler
+from lib.workers import run_worker, workers
 
 classes = {cls.__name__.lower(): cls for cls in BasePlugin.__subclasses__()}
 
+
+def configure_registry(name, config, settings):
+    """Applies the storage and series limit settings of a plugin to its metrics."""
+    if config.get("storage", settings.get("storage")) == "columnar":
+        REGISTRY.columnar(name)
+
+    # Caps every labeled metric of the plugin, also the ones created later.
+    max_series = config.get("max_series", settings.get("max_series"))
+    if max_series:
+        REGISTRY.limit(name, int(max_series), config.get("series_overflow", settings.get("series_overflow", True)))
+
+
 def signal_handler(_signo, _stack_frame):
     logging.info("Exited by signal {}".format(_signo))
     sys.exit(0)
@@ -26,6 +45,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Prometheus node exporter.')
     parser.add_argument('--config', default="config.json", help='config file to parse')
     parser.add_argument('--bind', default=":9090", help='address to bind')
+    parser.add_argument('--worker', help='run only this plugin, as a worker process of the server')
 
     args = parser.parse_args()
 
@@ -39,16 +59,48 @@ if __name__ == "__main__":
         exit()
 
 
+    settings = global_config.get("global", {})
+    collect_interval = settings.get("collect_interval")
+    scheduler.workers = int(settings.get("scheduler_workers", 2))
+
+    if args.worker:
+        name = args.worker
+        config = global_config["plugins"][name]
+        configure_registry(name, config, settings)
+        run_worker(classes[name], name, config, settings)
+        sys.exit(0)
+
     for name, config in global_config["plugins"].items():
         if not name in classes:
             logging.error("Plugin {} not found! skipped...".format(name))
             continue
+
+        # Plugins that may block or crash run in a process of their own.
+        if config.get("process"):
+            workers.add(name, args.config, settings)
+            logging.info("Plugin {} in a worker process".format(name))
+            continue
+
+        configure_registry(name, config, settings)
+
         try:
-            plugin = classes[name](config)
+            with REGISTRY.owner(name):
+                plugin = classes[name](config)
             plugins.append(plugin)
             logging.info("Plugin {}".format(name))
         except Exception as e:
             logging.error("Exception in {} while initialisation {}".format(name, e))
+            continue
+
+        plugin.collect_timeout = config.get("collect_timeout")
+        plugin.ttl = config.get("ttl", settings.get("ttl"))
+        plugin.publish = bool(settings.get("snapshots"))
+
+        # Without an interval the plugin is collected on every scrape.
+        interval = config.get("interval", collect_interval)
+        if interval and type(plugin).collect != BasePlugin.collect:
+            scheduler.add(name, partial(run_collect, plugin), interval, blocking=config.get("blocking", False))
+            plugin.scheduled = True
 
 
     for plugin in plugins:
@@ -57,6 +109,29 @@ if __name__ == "__main__":
         except Exception as e:
             logging.error("Exception {} in plugin {} on starting update".format(e, plugin.__class__.__name__))
 
+    # Pushing readers render the latest snapshot when snapshots are on.
+    # Plugins publish their own metrics, the job publishes the rest: the
+    # metrics without owner and those of worker processes.
+    readers_registry = REGISTRY
+    if settings.get("snapshots"):
+        scheduler.add("snapshot", partial(REGISTRY.publish, [worker.name for worker in workers.workers]),
+                      settings.get("snapshot_interval", 15))
+        # Everything, so scrapes before the first run of the job miss nothing.
+        REGISTRY.publish()
+        readers_registry = REGISTRY.snapshots()
+
+    if settings.get("graphite_address"):
+        host, graphite_port = settings["graphite_address"].split(":")
+        GraphiteBridge((host, int(graphite_port)), registry=readers_registry).start(settings.get("graphite_interval", 60))
+
+    if settings.get("textfile_path"):
+        scheduler.add("textfile", partial(write_to_textfile, settings["textfile_path"], readers_registry),
+                      settings.get("textfile_interval", 60))
+
+    atexit.register(workers.stop)
+    workers.start()
+    scheduler.start()
+
     address, port = args.bind.split(":")
-    start_http_server(int(port), address)
+    start_http_server(int(port), address, settings)
 
@@ -1,10 +1,19 @@
+import logging
+import os
+import Queue
+import re
+import threading
+import time
+
 from lib.prometheus_client.core import Gauge, Counter
+from lib.procfs import MountTable, ProcFile
 
 from base_plugin import BasePlugin, NAMESPACE
 
 
 class System(BasePlugin):
     STAT_FILE = "/proc/stat"
+    CPU_FIELDS = ["user", "nice", "system", "idle", "iowait", "irq", "softirq", "steal", "guest"]
 
     def __init__(self, config):
         self.cpu = Counter("cpu",
@@ -29,29 +38,32 @@ class System(BasePlugin):
         self.pblock = Gauge('procs_blocked',
                             "Number of processes blocked waiting for I/O to complete.",
                             namespace=NAMESPACE)
+        self.fields = {
+            "intr": self.intr,
+            "ctxt": self.ctxt,
+            "processes": self.forks,
+            "btime": self.btime,
+            "procs_running": self.prun,
+            "procs_blocked": self.pblock,
+        }
+        self.stat = ProcFile(self.STAT_FILE)
 
     def collect(self):
-        with open(self.STAT_FILE) as f:
-            for line in f:
+        cpu = dict()
+        for line in self.stat.read().splitlines():
+            if line.startswith("cpu"):
                 parts = line.split()
+                for i in xrange(1, min(len(parts), len(self.CPU_FIELDS))):
+                    cpu[(parts[0], self.CPU_FIELDS[i - 1])] = float(parts[i])
+                continue
+
+            # Only the first number is used, intr is followed by one per interrupt.
+            parts = line.split(None, 2)
+            metric = self.fields.get(parts[0])
+            if metric is not None:
+                metric.set(float(parts[1]))
 
-                if parts[0].startswith("cpu"):
-                    cpu_fields = ["user", "nice", "system", "idle", "iowait", "irq", "softirq", "steal", "guest"]
-                    for i in xrange(1, min(len(parts), len(cpu_fields))):
-                        self.cpu.labels(parts[0], cpu_fields[i - 1]).set(float(parts[i]))
-
-                elif parts[0].startswith("intr"):
-                    self.intr.set(float(parts[1]))
-                elif parts[0].startswith("ctxt"):
-                    self.ctxt.set(float(parts[1]))
-                elif parts[0].startswith("processes"):
-                    self.forks.set(float(parts[1]))
-                elif parts[0].startswith("btime"):
-                    self.btime.set(float(parts[1]))
-                elif parts[0].startswith("procs_running"):
-                    self.prun.set(float(parts[1]))
-                elif parts[0].startswith("procs_blocked"):
-                    self.pblock.set(float(parts[1]))
+        self.cpu.set_many(cpu)
 
 
 class LoadAvg(BasePlugin):
@@ -80,17 +92,17 @@ class LoadAvg(BasePlugin):
                              subsystem=self.SUBSYSTEM,
                              namespace=NAMESPACE)
 
+        self.loadavg = ProcFile(self.LOAD_AVG_FILE)
+
     def collect(self):
-        with open(self.LOAD_AVG_FILE) as f:
-            line = f.readline()
-            parts = line.split()
-            self.load1.set(float(parts[0]))
-            self.load5.set(float(parts[1]))
-            self.load15.set(float(parts[2]))
+        parts = self.loadavg.read().split()
+        self.load1.set(float(parts[0]))
+        self.load5.set(float(parts[1]))
+        self.load15.set(float(parts[2]))
 
-            r, e = parts[3].split('/')
-            self.runnable.set(float(r))
-            self.existed.set(float(e))
+        r, e = parts[3].split('/')
+        self.runnable.set(float(r))
+        self.existed.set(float(e))
 
 
 class MemInfo(BasePlugin):
@@ -98,47 +110,116 @@ class MemInfo(BasePlugin):
     SUBSYSTEM = 'meminfo'
 
     def __init__(self, config):
+        # Gauges by the field as it is written in the file.
         self.metrics = dict()
+        self.meminfo = ProcFile(self.MEM_INFO_FILE)
 
     def collect(self):
-        with open(self.MEM_INFO_FILE) as f:
-            for line in f:
-                parts = line.split()
+        for line in self.meminfo.read().splitlines():
+            parts = line.split()
 
+            metric = self.metrics.get(parts[0])
+            if metric is None:
                 name = parts[0].strip(':'). \
                     replace(r'(', '_'). \
                     replace(')', '').lower()
-                value = parts[1]
+                metric = self.metrics[parts[0]] = Gauge(name,
+                                                        name + " from " + self.MEM_INFO_FILE,
+                                                        subsystem=self.SUBSYSTEM,
+                                                        namespace=NAMESPACE)
 
-                if not name in self.metrics:
-                    self.metrics[name] = Gauge(name,
-                                               name + " from " + self.MEM_INFO_FILE,
-                                               subsystem=self.SUBSYSTEM,
-                                               namespace=NAMESPACE)
+            metric.set(float(parts[1]))
 
-                self.metrics[name].set(float(value))
 
+class StatvfsProbe(object):
+    """statvfs of one mountpoint, run on the worker pool of Filesystem.
 
-class Filesystem(BasePlugin):
-    MOUNT_FILE = "/proc/mounts"
-    SUBSYSTEM = 'filesystem'
+    Only one probe of a mountpoint runs at a time, so a mount that hangs
+    holds on to a single worker however often it is collected.
+    """
 
-    def __init__(self, config):
+    def __init__(self, mountpoint):
+        self.mountpoint = mountpoint
+        # Of the last statvfs that succeeded.
+        self.values = None
+        self.failed = False
+        self.backoff = 0
+        self.next_probe = 0
 
-        import re
+        # Set while statvfs is being called.
+        self.running = False
+        self.done = threading.Event()
+        self.done.set()
+        self._ok = False
 
-        self.exclude = config.get("exclude", "")
+    def start(self, queue):
+        self.done = threading.Event()
+        self._ok = False
+        queue.put((self, self.done))
 
-        self.mountpoints = []
-        with open(self.MOUNT_FILE) as f:
-            for line in f:
-                parts = line.split()
+    def run(self, done):
+        self.running = True
+        try:
+            res = os.statvfs(self.mountpoint)
+            self.values = {
+                "size": float(res.f_blocks * res.f_bsize),
+                "free": float(res.f_bfree * res.f_bsize),
+                "avail": float(res.f_bavail * res.f_bsize),
+                "files": float(res.f_files),
+                "files_free": float(res.f_ffree),
+            }
+            self._ok = True
+        except OSError as e:
+            logging.debug("No statvfs for {}: {}".format(self.mountpoint, e))
+        finally:
+            self.running = False
+            done.set()
+
+    def finish(self, now, min_backoff, max_backoff):
+        """Records whether the probe started last made it in time."""
+        self.failed = not (self.done.is_set() and self._ok)
+        if self.failed:
+            self.backoff = min(max(self.backoff * 2, min_backoff), max_backoff)
+            self.next_probe = now + self.backoff
+            logging.warning("statvfs of {} failed or timed out, probing again in {}s".format(self.mountpoint, self.backoff))
+        else:
+            self.backoff = 0
+            self.next_probe = 0
+
+
+class Filesystem(BasePlugin):
+    """Space and inodes of the mounted filesystems.
+
+    The mount table is read again only when the kernel reports a change,
+    and the exclude pattern is only matched against mountpoints new to it.
 
-                mountpoint = parts[1]
-                if re.match(self.exclude, mountpoint):
-                    continue
+    statvfs runs on a pool of `statvfs_workers` threads and a collection
+    waits `statvfs_timeout` seconds for it. A mount that fails or misses
+    the deadline keeps its last values, is flagged in
+    node_filesystem_device_error and is probed again after a backoff that
+    doubles up to `statvfs_max_backoff` seconds. A worker stuck in statvfs
+    past the deadline is replaced and leaves once its call returns, so
+    the other mounts always have `statvfs_workers` threads.
+    """
+    MOUNT_FILE = "/proc/self/mounts"
+    SUBSYSTEM = 'filesystem'
+
+    def __init__(self, config):
+        self.exclude = re.compile(config.get("exclude", ""))
+        self.workers = int(config.get("statvfs_workers", 4))
+        self.timeout = float(config.get("statvfs_timeout", 1))
+        self.max_backoff = float(config.get("statvfs_max_backoff", 300))
+
+        self.mounts = MountTable(self.MOUNT_FILE)
+        # All mountpoints of the table, and the probes of the ones not excluded.
+        self.table = set()
+        self.probes = dict()
 
-                self.mountpoints.append(mountpoint)
+        self.queue = Queue.Queue()
+        self.threads = []
+        # Probes stuck in statvfs past their deadline, each holding a worker.
+        self.hung = set()
+        self._lock = threading.Lock()
 
         labels = [
             ("size", "Filesystem size in bytes."),
@@ -146,6 +227,7 @@ class Filesystem(BasePlugin):
             ("avail", "Filesystem space available to non-root users in bytes."),
             ("files", "Filesystem total file nodes."),
             ("files_free", "Filesystem total free file nodes."),
+            ("device_error", "Whether the last statvfs of the filesystem failed or timed out."),
         ]
         self.metrics = dict()
         for name, desc in labels:
@@ -155,17 +237,81 @@ class Filesystem(BasePlugin):
                                        subsystem=self.SUBSYSTEM,
                                        namespace=NAMESPACE)
 
+        self.update_mountpoints()
+
+    def update_mountpoints(self):
+        if not self.mounts.changed():
+            return
+
+        table = set(self.mounts.mountpoints())
+        for mp in self.table - table:
+            if mp in self.probes:
+                logging.info("Filesystem {} unmounted".format(mp))
+                del self.probes[mp]
+                for metric in self.metrics.values():
+                    try:
+                        metric.remove(mp)
+                    except KeyError:
+                        pass
+        for mp in table - self.table:
+            if not self.exclude.match(mp):
+                logging.info("Filesystem {} mounted".format(mp))
+                self.probes[mp] = StatvfsProbe(mp)
+        self.table = table
+
+    def _work(self):
+        while True:
+            probe, done = self.queue.get()
+            probe.run(done)
+
+            with self._lock:
+                self.hung.discard(probe)
+                # This worker was replaced while it hung.
+                if len(self.threads) > self.workers + len(self.hung):
+                    self.threads.remove(threading.current_thread())
+                    return
+
+    def _start_workers(self):
+        with self._lock:
+            for probe in self.probes.values():
+                if probe.running and not probe.done.is_set():
+                    self.hung.add(probe)
+
+            while len(self.threads) < self.workers + len(self.hung):
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
     def collect(self):
-        import os
-
-        for mp in self.mountpoints[:]:
-            try:
-                res = os.statvfs(mp)
-            except Exception as e:
-                self.mountpoints.remove(mp)
-
-            self.metrics["size"].labels(mp).set(float(res.f_blocks * res.f_bsize))
-            self.metrics["free"].labels(mp).set(float(res.f_bfree * res.f_bsize))
-            self.metrics["avail"].labels(mp).set(float(res.f_bavail * res.f_bsize))
-            self.metrics["files"].labels(mp).set(float(res.f_files))
-            self.metrics["files_free"].labels(mp).set(float(res.f_ffree))
+        self.update_mountpoints()
+        self._start_workers()
+
+        started = time.time()
+        # Probes still running from an earlier collection are not started
+        # again, and neither are the ones backing off.
+        running = [probe for probe in self.probes.values()
+                   if probe.done.is_set() and started >= probe.next_probe]
+        # Mounts that answered last time go first, ahead of the suspect ones.
+        running.sort(key=lambda probe: probe.failed)
+        for probe in running:
+            probe.start(self.queue)
+
+        deadline = started + self.timeout
+        for probe in running:
+            probe.done.wait(max(deadline - time.time(), 0))
+        now = time.time()
+        for probe in running:
+            probe.finish(now, self.timeout, self.max_backoff)
+        # Probes queued behind the ones that hang get workers of their own.
+        self._start_workers()
+
+        values = dict((name, {}) for name in self.metrics)
+        for mp, probe in self.probes.items():
+            values["device_error"][mp] = float(probe.failed)
+            if probe.values is not None:
+                for name, value in probe.values.items():
+                    values[name][mp] = value
+
+        for name, metric in self.metrics.items():
+            metric.set_many(values[name])
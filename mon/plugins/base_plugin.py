@@ -2,6 +2,16 @@ NAMESPACE = "node"
 
 
 class BasePlugin(object):
+    # Set when collect() runs on the background scheduler instead of on scrape.
+    scheduled = False
+    # Seconds a scrape waits for collect() before serving the last values.
+    collect_timeout = None
+    # Collections a labeled series may go without update before it is dropped.
+    ttl = None
+    # Set when readers render registry snapshots, collect() is then followed
+    # by publishing the plugin's metrics.
+    publish = False
+
     def __init__(self, config):
         print self.__class__.__name__, "inited"
         pass
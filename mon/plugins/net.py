@@ -3,16 +3,48 @@ import re
 import logging
 
 from base_plugin import BasePlugin, NAMESPACE
-from lib.prometheus_client import Gauge
+from lib.netlink import IFF_UP, OPERSTATE_UP, STATS64_FIELDS, RouteSocket
+from lib.procfs import ProcFile, ProcFiles
+from lib.prometheus_client import Gauge, Summary
+from lib.scheduler import scheduler
 
 
 class NetDev(BasePlugin):
+    """Interface counters from /proc/net/dev, or from netlink with "backend": "netlink".
+
+    The netlink backend gets the 64 bit counters, carrier and operational
+    state of all interfaces with one RTM_GETLINK dump and exports the
+    counters as /proc/net/dev would show them.
+    """
     INTERFACE_PATH = "/sys/class/net"
     NET_DEV_FILE = "/proc/net/dev"
     SUBSYSTEM = 'netdev'
 
+    # The fields of rtnl_link_stats64 /proc/net/dev adds up for each column.
+    STATS64 = {
+        "rx_bytes": ["rx_bytes"],
+        "rx_packets": ["rx_packets"],
+        "rx_errs": ["rx_errors"],
+        "rx_drop": ["rx_dropped", "rx_missed_errors"],
+        "rx_fifo": ["rx_fifo_errors"],
+        "rx_frame": ["rx_length_errors", "rx_over_errors", "rx_crc_errors", "rx_frame_errors"],
+        "rx_compressed": ["rx_compressed"],
+        "rx_multicast": ["multicast"],
+        "tx_bytes": ["tx_bytes"],
+        "tx_packets": ["tx_packets"],
+        "tx_errs": ["tx_errors"],
+        "tx_drop": ["tx_dropped"],
+        "tx_fifo": ["tx_fifo_errors"],
+        "tx_colls": ["collisions"],
+        "tx_carrier": ["tx_carrier_errors", "tx_aborted_errors", "tx_window_errors", "tx_heartbeat_errors"],
+        "tx_compressed": ["tx_compressed"],
+    }
+
     def __init__(self, config):
         self.exclude = config.get('exclude', '')
+        self.backend = config.get('backend', 'proc')
+        if self.backend not in ('proc', 'netlink'):
+            raise ValueError("Unknown netdev backend: {}".format(self.backend))
         self.metrics = dict()
 
         self.names = ["rx_bytes", "rx_packets", "rx_errs", "rx_drop", "rx_fifo",
@@ -31,77 +63,113 @@ class NetDev(BasePlugin):
                                         namespace=NAMESPACE,
                                         labelnames=["device"])
 
-    def collect(self):
-        with open(self.NET_DEV_FILE) as f:
-            f.readline()
-            f.readline()
-
-            for line in f:
-                parts = line.split()
-
-                iface = parts[0].strip(':')
-                if re.match(self.exclude, iface):
-                    continue
-
-                for i in xrange(0, len(self.names)):
-                    value = parts[i + 1]
-                    self.metrics[self.names[i]].labels(iface).set(float(value))
+        if self.backend == 'netlink':
+            self.metrics["up"] = Gauge("up",
+                                       "Whether the operational state of the interface is up.",
+                                       subsystem=self.SUBSYSTEM,
+                                       namespace=NAMESPACE,
+                                       labelnames=["device"])
+            self.route = RouteSocket()
+            fields = [(name, [STATS64_FIELDS.index(field) for field in self.STATS64[name]]) for name in self.names]
+            self.stats64 = [(name, indexes[0]) for name, indexes in fields if len(indexes) == 1]
+            self.stats64_sums = [(name, indexes) for name, indexes in fields if len(indexes) > 1]
+        else:
+            self.net_dev = ProcFile(self.NET_DEV_FILE)
+            self.carriers = ProcFiles(size=64)
 
-                cable_exists = open(os.path.join(self.INTERFACE_PATH, iface, "carrier")).read()
-                self.metrics["carrier"].labels(iface).set(float(cable_exists))
+    def collect(self):
+        values = dict((name, {}) for name in self.metrics)
+        if self.backend == 'netlink':
+            self.read_netlink(values)
+        else:
+            self.read_proc(values)
+
+        for name, metric in self.metrics.items():
+            metric.set_many(values[name])
+
+    def read_netlink(self, values):
+        for link in self.route.links():
+            if link.name is None or link.stats is None or re.match(self.exclude, link.name):
+                continue
+
+            stats = link.stats
+            for name, i in self.stats64:
+                values[name][link.name] = float(stats[i])
+            for name, fields in self.stats64_sums:
+                values[name][link.name] = float(sum([stats[i] for i in fields]))
+
+            # Like sysfs, which has no carrier for an interface that is down.
+            if link.carrier is not None and link.flags & IFF_UP:
+                values["carrier"][link.name] = float(link.carrier)
+            values["up"][link.name] = float(link.operstate == OPERSTATE_UP)
+
+    def read_proc(self, values):
+        carriers = []
+        for line in self.net_dev.read().splitlines()[2:]:
+            parts = line.split()
+
+            iface = parts[0].strip(':')
+            if re.match(self.exclude, iface):
+                continue
+
+            for i in xrange(0, len(self.names)):
+                values[self.names[i]][iface] = float(parts[i + 1])
+
+            # Reading the carrier of an interface that is down fails.
+            carrier = os.path.join(self.INTERFACE_PATH, iface, "carrier")
+            carriers.append(carrier)
+            try:
+                values["carrier"][iface] = float(self.carriers.read(carrier))
+            except (IOError, ValueError) as e:
+                logging.debug("No carrier for {}: {}".format(iface, e))
+
+        # Interfaces that are gone keep no file open.
+        self.carriers.retain(carriers)
 
 
 class Ping(BasePlugin):
     class PingTarget(object):
 
-        import threading
-
-        class PingThread(threading.Thread):
-            def __init__(self, interval, host, timeout, metric):
-                super(self.__class__, self).__init__()
-                self.interval = interval
-                self.host = host
-                self.timeout = timeout
-                self.metric = metric
-
-            def run(self):
-                from time import sleep
-                import lib.ping as ping
-
-                while True:
-                    res_timeout = float(self.timeout)
-                    try:
-                        timeout = ping.do_one(self.host, self.timeout)
-                        if timeout is not None:
-                            res_timeout = timeout
-                    except Exception as e:
-                        logging.info("Error while ping {}, {}".format(self.host, e))
-                    finally:
-                        self.metric.labels(self.host).set(res_timeout * 1000)  # ms
-
-                    sleep(self.interval)
-
-        def __init__(self, config, metric):
+        def __init__(self, config, metric, rtt):
             self.host = config.get('address')
             self.timeout = config.get('timeout', 1)
             self.interval = config.get('interval', 5)
             self.metric = metric
+            self.rtt = rtt
+
+        def ping(self):
+            import lib.ping as ping
+
+            res_timeout = float(self.timeout)
+            try:
+                timeout = ping.do_one(self.host, self.timeout)
+                if timeout is not None:
+                    res_timeout = timeout
+                    self.rtt.labels(self.host).observe(timeout)
+            except Exception as e:
+                logging.info("Error while ping {}, {}".format(self.host, e))
+            finally:
+                self.metric.labels(self.host).set(res_timeout * 1000)  # ms
 
         def start_update(self):
-            self.thread = Ping.PingTarget.PingThread(self.interval, self.host, self.timeout, self.metric)
-            self.thread.daemon = True
-            self.thread.start()
+            scheduler.add("ping " + self.host, self.ping, self.interval, blocking=True)
 
     def __init__(self, config):
         self.metric = Gauge("ping",
                             "Ping to host",
                             namespace=NAMESPACE,
                             labelnames=["host"])
+        self.rtt = Summary("ping_rtt_seconds",
+                           "Round trip time of answered pings",
+                           namespace=NAMESPACE,
+                           labelnames=["host"],
+                           quantiles=config.get('quantiles', [[0.5, 0.05], [0.99, 0.001]]),
+                           max_age=config.get('max_age', 600))
 
         self.configs = config.get('targets')
         self.targets = []
         for config in self.configs:
-            self.targets.append(Ping.PingTarget(config, self.metric))
+            self.targets.append(Ping.PingTarget(config, self.metric, self.rtt))
 
     def start_update(self):
         for target in self.targets:
@@ -125,6 +193,7 @@ class NetDevExists(BasePlugin):
     def collect(self):
         dirs = os.listdir(self.INTERFACE_PATH)
 
+        values = dict()
         for ask_iface in self.interfaces:
             exists = False
 
@@ -133,4 +202,6 @@ class NetDevExists(BasePlugin):
                     exists |= True
                     break
 
-            self.metric.labels(ask_iface).set(float(exists))
+            values[ask_iface] = float(exists)
+
+        self.metric.set_many(values)
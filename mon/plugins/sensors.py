@@ -28,10 +28,10 @@ class LMSensors(BasePlugin):
 
     def collect(self):
         for chip in self.chips:
+            values = dict()
             for feature in chip:
-                self.metrics[str(chip)]. \
-                    labels(feature.name, feature.label). \
-                    set(float(feature.get_value()))
+                values[(feature.name, feature.label)] = float(feature.get_value())
+            self.metrics[str(chip)].set_many(values)
 
 
 class Imx28(BasePlugin):
@@ -58,6 +58,5 @@ class Imx28(BasePlugin):
 
         temp = (raw - 1075.69) * 0.253
 
-        self.metric.labels("voltage").set(voltage)
-        self.metric.labels("cpu_temp").set(temp)
+        self.metric.set_many({"voltage": voltage, "cpu_temp": temp})
 
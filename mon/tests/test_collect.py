@@ -0,0 +1,119 @@
+import unittest
+
+from lib.collect import evicted, run_collect
+from lib.prometheus_client import Gauge, Summary, REGISTRY
+from plugins.base_plugin import BasePlugin, NAMESPACE
+
+
+class JobPlugin(BasePlugin):
+    """Writes its series from a scheduler job, like Ping."""
+
+    def __init__(self, config):
+        self.value = Gauge("test_job_value", "Written by a job.", labelnames=["host"], namespace=NAMESPACE)
+        self.rtt = Summary("test_job_rtt", "Observed by a job.", labelnames=["host"], namespace=NAMESPACE,
+                           quantiles=[[0.5, 0.05]])
+
+    def update(self):
+        self.value.labels("a").set(1)
+        self.rtt.labels("a").observe(0.5)
+
+
+class CollectPlugin(BasePlugin):
+
+    def __init__(self, config):
+        self.value = Gauge("test_collect_value", "Written by collect.", labelnames=["host"], namespace=NAMESPACE)
+        self.hosts = ["a", "b"]
+
+    def collect(self):
+        for host in self.hosts:
+            self.value.labels(host).set(1)
+
+
+class SnapshotPlugin(BasePlugin):
+
+    def __init__(self, config):
+        self.value = Gauge("test_snapshot_value", "Written by collect.", namespace=NAMESPACE)
+        self.next = 1
+
+    def collect(self):
+        self.value.set(self.next)
+
+
+def value(name, labels=None):
+    return REGISTRY.get_sample_value(name, labels or {})
+
+
+class TTLTest(unittest.TestCase):
+
+    def test_job_interval_longer_than_scrape_period(self):
+        with REGISTRY.owner("jobplugin"):
+            plugin = JobPlugin({})
+        plugin.ttl = 3
+
+        # One job run, then many scrapes before the next one.
+        plugin.update()
+        for _ in xrange(10):
+            run_collect(plugin)
+
+        self.assertEqual(1, value("node_test_job_value", {"host": "a"}))
+        self.assertEqual(1, value("node_test_job_rtt_count", {"host": "a"}))
+        self.assertEqual(0.5, value("node_test_job_rtt", {"host": "a", "quantile": "0.5"}))
+        self.assertEqual(0, value("node_scrape_collector_series_evicted", {"collector": "jobplugin"}) or 0)
+
+    def test_collect_drops_series_not_written_for_ttl_collections(self):
+        with REGISTRY.owner("collectplugin"):
+            plugin = CollectPlugin({})
+        plugin.ttl = 3
+
+        run_collect(plugin)
+        plugin.hosts = ["a"]
+        for _ in xrange(3):
+            run_collect(plugin)
+
+        self.assertEqual(1, value("node_test_collect_value", {"host": "a"}))
+        self.assertIsNone(value("node_test_collect_value", {"host": "b"}))
+        self.assertEqual(1, value("node_scrape_collector_series_evicted", {"collector": "collectplugin"}))
+
+
+def published(snapshot, name):
+    for metric in snapshot.collect():
+        for sample_name, _, sample_value in metric._samples:
+            if sample_name == name:
+                return sample_value
+    return None
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def test_collect_publishes_only_its_plugin(self):
+        with REGISTRY.owner("snapshotplugin"):
+            plugin = SnapshotPlugin({})
+        plugin.publish = True
+        other = Gauge("test_snapshot_other", "Not published by the plugin.", namespace=NAMESPACE)
+        other.set(1)
+        REGISTRY.publish()
+
+        other.set(2)
+        plugin.next = 2
+        run_collect(plugin)
+
+        snapshot = REGISTRY.snapshot()
+        self.assertEqual(2, published(snapshot, "node_test_snapshot_value"))
+        self.assertEqual(1, published(snapshot, "node_test_snapshot_other"))
+        # Scrapes restricted to the plugin read its metrics and the unowned ones.
+        restricted = snapshot.restricted_registry(["snapshotplugin"])
+        self.assertIn("node_test_snapshot_value", [metric._name for metric in restricted.collect()])
+
+        # Writes after the collection wait for the next one.
+        plugin.value.set(3)
+        plugin.next = 3
+        self.assertEqual(2, published(REGISTRY.snapshot(), "node_test_snapshot_value"))
+        run_collect(plugin)
+        self.assertEqual(3, published(REGISTRY.snapshot(), "node_test_snapshot_value"))
+        self.assertEqual([("node_test_snapshot_value", {}, 3)],
+                         REGISTRY.snapshot().get_samples("node_test_snapshot_value"))
+        self.assertEqual(1, published(REGISTRY.snapshot(), "node_test_snapshot_other"))
+
+
+if __name__ == "__main__":
+    unittest.main()
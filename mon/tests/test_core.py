@@ -0,0 +1,107 @@
+import time
+import unittest
+
+from lib.prometheus_client.core import _WindowedQuantiles
+from lib.prometheus_client import (CollectorRegistry, Counter, Gauge, Histogram, Summary, generate_latest,
+                                   generate_openmetrics)
+
+
+def value(registry, name, labels=None):
+    return registry.get_sample_value(name, labels or {})
+
+
+class ColumnarTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = CollectorRegistry()
+        self.registry.columnar("plugin")
+
+    def test_scope_keeps_summaries_and_histograms_in_objects(self):
+        with self.registry.owner("plugin"):
+            summary = Summary("rtt", "Summary.", ["host"], registry=self.registry,
+                              quantiles=[[0.5, 0.05]], max_age=60)
+            histogram = Histogram("run", "Histogram.", ["host"], registry=self.registry, buckets=(1.0, 2.0))
+            gauge = Gauge("up", "Gauge.", ["host"], registry=self.registry)
+
+        summary.labels("a").observe(0.5)
+        histogram.labels("a").observe(1.5)
+        gauge.labels("a").set(1)
+
+        self.assertEqual(1, value(self.registry, "rtt_count", {"host": "a"}))
+        self.assertEqual(0.5, value(self.registry, "rtt", {"host": "a", "quantile": "0.5"}))
+        self.assertEqual(1, value(self.registry, "run_bucket", {"host": "a", "le": "2.0"}))
+        self.assertEqual(1, value(self.registry, "up", {"host": "a"}))
+        self.assertEqual("_ColumnarLabelWrapper", type(gauge).__name__)
+
+    def test_explicit_columnar_summary_is_refused(self):
+        with self.assertRaises(ValueError):
+            Summary("rtt", "Summary.", ["host"], registry=self.registry, columnar=True, max_age=60)
+
+    def test_handle_of_removed_series_does_not_write_its_successor(self):
+        counter = Counter("c", "Counter.", ["host"], registry=self.registry, columnar=True)
+        stale = counter.labels("a")
+        stale.inc()
+        counter.remove("a")
+
+        # Takes over the id of "a".
+        counter.labels("b").inc(5)
+        stale.inc(100)
+
+        self.assertEqual(5, value(self.registry, "c", {"host": "b"}))
+        self.assertIsNone(value(self.registry, "c", {"host": "a"}))
+
+    def test_handle_of_evicted_series_does_not_write_its_successor(self):
+        gauge = Gauge("g", "Gauge.", ["host"], registry=self.registry, columnar=True, ttl=1)
+        stale = gauge.labels("a")
+        stale.set(1)
+        gauge._expire()
+        gauge._expire()
+
+        gauge.labels("b").set(2)
+        stale.set(3)
+        gauge.set_many({"b": 4})
+
+        self.assertEqual(4, value(self.registry, "g", {"host": "b"}))
+        self.assertIsNone(value(self.registry, "g", {"host": "a"}))
+
+
+class WindowedQuantilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.quantiles = _WindowedQuantiles([(0.5, 0.05)], 10, 5)
+        self.start = self.quantiles._next_rotation
+
+    def test_forward_jump_rotates_at_once(self):
+        self.quantiles.insert(1.0)
+        now = self.start + 56 * 365 * 86400 + 0.5
+        started = time.time()
+        self.quantiles._rotate(now)
+        self.assertLess(time.time() - started, 0.1)
+
+        self.assertTrue(self.quantiles._next_rotation > now)
+        self.assertTrue(self.quantiles._next_rotation <= now + 2)
+        self.assertTrue(all(not stream._samples for stream in self.quantiles._streams))
+
+    def test_backward_step_restarts_the_interval(self):
+        now = self.start - 3600
+        self.quantiles._rotate(now)
+        self.assertEqual(now + 2, self.quantiles._next_rotation)
+
+
+class FormatTest(unittest.TestCase):
+
+    def test_non_finite_values(self):
+        registry = CollectorRegistry()
+        gauge = Gauge("g", "Gauge.", ["v"], registry=registry)
+        gauge.labels("nan").set(float("nan"))
+        gauge.labels("inf").set(float("inf"))
+        gauge.labels("-inf").set(float("-inf"))
+
+        for text in (generate_latest(registry), generate_openmetrics(registry)):
+            self.assertIn(b'g{v="nan"} NaN\n', text)
+            self.assertIn(b'g{v="inf"} +Inf\n', text)
+            self.assertIn(b'g{v="-inf"} -Inf\n', text)
+
+
+if __name__ == "__main__":
+    unittest.main()
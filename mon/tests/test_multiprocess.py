@@ -0,0 +1,36 @@
+import shutil
+import tempfile
+import unittest
+
+from lib.prometheus_client import CollectorRegistry, Gauge
+from lib.prometheus_client.multiprocess import MultiProcessCollector, MultiProcessWriter
+
+
+class RejectedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_refusals_of_a_worker_reach_the_server(self):
+        worker = CollectorRegistry()
+        worker.limit("ping", 1, True)
+        with worker.owner("ping"):
+            gauge = Gauge("rtt", "Gauge.", ["host"], registry=worker)
+        for host in ("a", "b", "c"):
+            gauge.labels(host).set(1)
+        MultiProcessWriter(self.directory).flush(worker, "ping")
+
+        server = CollectorRegistry()
+        with server.owner("ping"):
+            collector = MultiProcessCollector(self.directory, registry=server)
+
+        self.assertEqual(2, server.rejected("ping"))
+        # The total is no sample.
+        self.assertEqual(["rtt"], [metric._name for metric in collector.collect()])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,197 @@
+import socket
+import struct
+import threading
+import unittest
+
+from lib import netlink
+from lib.netlink import (IFF_UP, IFLA_CARRIER, IFLA_IFNAME, IFLA_OPERSTATE, IFLA_STATS64, NLMSG_DONE,
+                         OPERSTATE_UP, RTM_NEWLINK, STATS64_FIELDS, RouteSocket)
+from lib.prometheus_client import REGISTRY
+from plugins.net import NetDev
+
+# Field i of every crafted rtnl_link_stats64 is 1000 + i.
+STATS = tuple(1000 + i for i in range(len(STATS64_FIELDS)))
+
+
+def attr(typ, payload, length=None):
+    '''An rtattr with its padding, length defaults to the real one.'''
+    if length is None:
+        length = 4 + len(payload)
+    data = struct.pack("=HH", length, typ) + payload
+    return data + b"\0" * (-len(data) % 4)
+
+
+def newlink(seq, attrs, flags=IFF_UP, length=None):
+    body = netlink._IFINFOMSG.pack(socket.AF_UNSPEC, 0, 1, flags, 0) + b"".join(attrs)
+    return message(RTM_NEWLINK, seq, body, length)
+
+
+def message(typ, seq, body=b"", length=None):
+    if length is None:
+        length = netlink._NLMSGHDR.size + len(body)
+    data = netlink._NLMSGHDR.pack(length, typ, 0, seq, 0) + body
+    return data + b"\0" * (-len(data) % 4)
+
+
+def link_attrs(name, stats=STATS, operstate=OPERSTATE_UP, carrier=1):
+    return [attr(IFLA_IFNAME, name + b"\0"),
+            attr(IFLA_OPERSTATE, struct.pack("=B", operstate)),
+            attr(IFLA_CARRIER, struct.pack("=B", carrier)),
+            attr(IFLA_STATS64, netlink._STATS64.pack(*stats))]
+
+
+class FakeSocket(object):
+    '''Hands out the given datagrams, one per recv_into().'''
+
+    def __init__(self, datagrams):
+        self.datagrams = list(datagrams)
+
+    def send(self, data):
+        return len(data)
+
+    def recv_into(self, buf):
+        data = self.datagrams.pop(0)
+        buf[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        pass
+
+
+def dump(*datagrams):
+    route = RouteSocket()
+    route._socket = FakeSocket(datagrams)
+    return route.links()
+
+
+class ParseTest(unittest.TestCase):
+
+    def test_link(self):
+        links = dump(newlink(1, link_attrs(b"eth0")) + message(NLMSG_DONE, 1))
+
+        self.assertEqual(1, len(links))
+        link = links[0]
+        self.assertEqual("eth0", link.name)
+        self.assertEqual(IFF_UP, link.flags)
+        self.assertEqual(OPERSTATE_UP, link.operstate)
+        self.assertEqual(1, link.carrier)
+        self.assertEqual(STATS, link.stats)
+
+    def test_zero_length_attribute_ends_the_walk(self):
+        attrs = [attr(IFLA_IFNAME, b"eth0\0"), attr(IFLA_OPERSTATE, b"", length=0)]
+        links = []
+        thread = threading.Thread(target=lambda: links.extend(
+            dump(newlink(1, attrs) + message(NLMSG_DONE, 1))))
+        thread.daemon = True
+        thread.start()
+        thread.join(2)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual("eth0", links[0].name)
+        self.assertIsNone(links[0].stats)
+
+    def test_truncated_message(self):
+        # The message claims more than the datagram holds, the stats are cut.
+        full = newlink(1, link_attrs(b"eth0"))
+        truncated = full[:-16]
+        links = dump(truncated, message(NLMSG_DONE, 1))
+
+        self.assertEqual("eth0", links[0].name)
+        self.assertIsNone(links[0].stats)
+
+    def test_message_shorter_than_ifinfomsg_is_skipped(self):
+        short = message(RTM_NEWLINK, 1, b"\0" * 8)
+        links = dump(short + newlink(1, link_attrs(b"eth1")) + message(NLMSG_DONE, 1))
+
+        self.assertEqual(["eth1"], [link.name for link in links])
+
+    def test_alignment_padding(self):
+        # Names of 1 to 4 bytes leave every amount of padding after them.
+        names = [b"a", b"ab", b"abc", b"abcd"]
+        links = dump(b"".join(newlink(1, link_attrs(name, operstate=2, carrier=0)) for name in names)
+                     + message(NLMSG_DONE, 1))
+
+        self.assertEqual(names, [link.name for link in links])
+        self.assertEqual([2] * 4, [link.operstate for link in links])
+        self.assertEqual([0] * 4, [link.carrier for link in links])
+        self.assertEqual([STATS] * 4, [link.stats for link in links])
+
+    def test_replies_to_other_dumps_are_ignored(self):
+        links = dump(newlink(7, link_attrs(b"old")) + newlink(1, link_attrs(b"eth0")) + message(NLMSG_DONE, 1))
+
+        self.assertEqual(["eth0"], [link.name for link in links])
+
+
+class NetDevTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        with REGISTRY.owner("netdevtest"):
+            cls.plugin = NetDev({"backend": "netlink", "exclude": "^$"})
+
+    def value(self, name, device):
+        return REGISTRY.get_sample_value("node_netdev_" + name, {"device": device})
+
+    def test_stats64_mapping(self):
+        self.plugin.route._socket = FakeSocket([newlink(self.plugin.route._seq + 1, link_attrs(b"eth9"))
+                                                + message(NLMSG_DONE, self.plugin.route._seq + 1)])
+        self.plugin.collect()
+
+        def field(name):
+            return STATS[STATS64_FIELDS.index(name)]
+
+        self.assertEqual(field("rx_bytes"), self.value("rx_bytes", "eth9"))
+        self.assertEqual(field("tx_packets"), self.value("tx_packets", "eth9"))
+        self.assertEqual(field("multicast"), self.value("rx_multicast", "eth9"))
+        self.assertEqual(field("collisions"), self.value("tx_colls", "eth9"))
+        self.assertEqual(field("rx_dropped") + field("rx_missed_errors"), self.value("rx_drop", "eth9"))
+        self.assertEqual(sum(field(f) for f in ("rx_length_errors", "rx_over_errors",
+                                                "rx_crc_errors", "rx_frame_errors")),
+                         self.value("rx_frame", "eth9"))
+        self.assertEqual(sum(field(f) for f in ("tx_carrier_errors", "tx_aborted_errors",
+                                                "tx_window_errors", "tx_heartbeat_errors")),
+                         self.value("tx_carrier", "eth9"))
+        self.assertEqual(1, self.value("carrier", "eth9"))
+        self.assertEqual(1, self.value("up", "eth9"))
+
+
+def proc_lo():
+    '''The rx_bytes and tx_packets of lo in /proc/net/dev.'''
+    with open("/proc/net/dev") as f:
+        for line in f.readlines()[2:]:
+            name, fields = line.split(":", 1)
+            if name.strip() == "lo":
+                fields = fields.split()
+                return int(fields[0]), int(fields[9])
+    return None
+
+
+def netlink_available():
+    try:
+        socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, netlink.NETLINK_ROUTE).close()
+    except (AttributeError, socket.error):
+        return False
+    return proc_lo() is not None
+
+
+@unittest.skipUnless(netlink_available(), "needs AF_NETLINK and a loopback interface")
+class LoopbackTest(unittest.TestCase):
+
+    def test_counters_match_proc_net_dev(self):
+        route = RouteSocket()
+        try:
+            before = proc_lo()
+            links = dict((link.name, link) for link in route.links())
+            after = proc_lo()
+        finally:
+            route.close()
+
+        stats = links["lo"].stats
+        rx_bytes = stats[STATS64_FIELDS.index("rx_bytes")]
+        tx_packets = stats[STATS64_FIELDS.index("tx_packets")]
+        self.assertTrue(before[0] <= rx_bytes <= after[0])
+        self.assertTrue(before[1] <= tx_packets <= after[1])
+
+
+if __name__ == "__main__":
+    unittest.main()